@@ -0,0 +1,186 @@
+import collections
+import os
+import threading
+import time
+
+# How far back submissions_per_minute looks.
+RATE_WINDOW = 300
+
+
+# The tasks that grade pages. in_flight only counts these, not emails or reporting results.
+GRADING_TASKS = ('graderapi.grade_test', 'graderapi.grade_page_task')
+
+
+class IntakeMonitor:
+    """
+    Keeps track of how far behind the workers are, so the intake endpoint can turn submissions away
+    (with a 503 the form provider retries) instead of letting the broker backlog grow without bound.
+
+    The backlog is the number of messages waiting in the grading queue. That is one grade_test per
+    submission, or (when pages are graded in parallel) one grade_page_task per page plus one
+    report_results_task per submission, plus any emails when CELERY_EMAIL_QUEUE isn't set. So it
+    counts grading tasks, not submissions. Reading it is one round trip to the broker, so it is
+    cached for a few seconds and refreshed by one request at a time.
+
+    The grading tasks the workers are running or have prefetched (in_flight) are only read for
+    get_status, since asking the workers is a broadcast that waits up to a second for each answer.
+    """
+    def __init__(self, app, high_water=None, retry_after=None, cache_seconds=None):
+        """
+        Args:
+            app (Celery): The celery app submissions are queued on.
+            high_water (int): The backlog (waiting grading tasks) at which we start turning submissions
+                away. Defaults to the INTAKE_HIGH_WATER environment variable, or 0 (never).
+            retry_after (int): The seconds we ask the sender to wait before retrying. Defaults to the
+                INTAKE_RETRY_AFTER environment variable, or 60.
+            cache_seconds (float): How long the backlog numbers are reused. Defaults to the
+                INTAKE_CACHE_SECONDS environment variable, or 5.
+        """
+        if high_water is None:
+            high_water = int(os.getenv('INTAKE_HIGH_WATER', 0))
+        if retry_after is None:
+            retry_after = int(os.getenv('INTAKE_RETRY_AFTER', 60))
+        if cache_seconds is None:
+            cache_seconds = float(os.getenv('INTAKE_CACHE_SECONDS', 5))
+        self.app = app
+        self.high_water = high_water
+        self.retry_after = retry_after
+        self.cache_seconds = cache_seconds
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+        self.workers_lock = threading.Lock()
+        self.checked = None
+        self.workers_checked = None
+        self.queue_depth = None
+        self.in_flight = None
+        self.completed = None
+        self.accepted = 0
+        self.rejected = 0
+        self.accepted_times = collections.deque()
+
+    def read_queue_depth(self):
+        """
+        Returns:
+            depth (int): How many messages are waiting in the grading queue.
+        """
+        with self.app.connection_for_read() as conn:
+            return conn.default_channel.queue_declare(queue=self.app.conf.task_default_queue, passive=True).message_count
+
+    def read_workers(self):
+        """
+        Returns:
+            in_flight (int): How many grading tasks (see GRADING_TASKS) the workers are running or have
+                prefetched, or None if no worker answered (or the broker can't broadcast, like the 
+                filesystem broker).
+            completed (int): How many grading tasks the workers have finished since they started, or None.
+        """
+        inspect = self.app.control.inspect(timeout=1.0)
+        active = inspect.active()
+        if not active:
+            return None, None
+        reserved = inspect.reserved() or {}
+        stats = inspect.stats() or {}
+        in_flight = sum(1 for tasks in list(active.values()) + list(reserved.values())
+                        for task in tasks if task.get('name') in GRADING_TASKS)
+        completed = sum(count for worker in stats.values()
+                        for name, count in worker.get('total', {}).items() if name in GRADING_TASKS)
+        return in_flight, completed
+
+    def refresh(self):
+        """
+        Reads the queue depth again if the cached one is too old. If another request is already
+        reading it, this one uses the cached number.
+        """
+        if self.checked is not None and time.monotonic() - self.checked < self.cache_seconds:
+            return
+        if not self.refresh_lock.acquire(blocking=False):
+            return
+        try:
+            try:
+                queue_depth = self.read_queue_depth()
+            except Exception as e:
+                print(f'Unable to read the queue depth: {e}')
+                queue_depth = None
+            with self.lock:
+                self.queue_depth = queue_depth
+                self.checked = time.monotonic()
+        finally:
+            self.refresh_lock.release()
+
+    def refresh_workers(self):
+        """
+        Asks the workers what they are doing again if the cached answer is too old.
+        """
+        if self.workers_checked is not None and time.monotonic() - self.workers_checked < self.cache_seconds:
+            return
+        if not self.workers_lock.acquire(blocking=False):
+            return
+        try:
+            try:
+                in_flight, completed = self.read_workers()
+            except Exception as e:
+                print(f'Unable to ask the workers what they are doing: {e}')
+                in_flight, completed = None, None
+            with self.lock:
+                self.in_flight = in_flight
+                self.completed = completed
+                self.workers_checked = time.monotonic()
+        finally:
+            self.workers_lock.release()
+
+    def get_backlog(self):
+        """
+        Returns:
+            backlog (int): How many grading tasks are waiting in the queue, or None if we couldn't read it.
+        """
+        self.refresh()
+        with self.lock:
+            return self.queue_depth
+
+    def should_accept(self):
+        """
+        Returns:
+            bool: False if the backlog is at the high water mark. If we can't tell, we accept.
+        """
+        if self.high_water <= 0:
+            return True
+        backlog = self.get_backlog()
+        if backlog is None or backlog < self.high_water:
+            return True
+        with self.lock:
+            self.rejected += 1
+        print(f'Turning a submission away, the backlog is {backlog} (high water mark {self.high_water})')
+        return False
+
+    def record_accepted(self):
+        now = time.monotonic()
+        with self.lock:
+            self.accepted += 1
+            self.accepted_times.append(now)
+            while self.accepted_times[0] < now - RATE_WINDOW:
+                self.accepted_times.popleft()
+
+    def get_status(self):
+        """
+        Returns:
+            status (dict): The backlog, the grading tasks in flight, whether we are accepting submissions, 
+                and how many this process accepted and turned away (and how many per minute it accepted lately).
+        """
+        backlog = self.get_backlog()
+        self.refresh_workers()
+        now = time.monotonic()
+        with self.lock:
+            recent = sum(1 for accepted_time in self.accepted_times if accepted_time >= now - RATE_WINDOW)
+            return {
+                'queue_depth': self.queue_depth,
+                'in_flight': self.in_flight,
+                'backlog': backlog,
+                'high_water': self.high_water,
+                'accepting': self.high_water <= 0 or backlog is None or backlog < self.high_water,
+                'retry_after': self.retry_after,
+                'completed': self.completed,
+                'accepted': self.accepted,
+                'rejected': self.rejected,
+                'submissions_per_minute': recent * 60 / RATE_WINDOW,
+                'checked_seconds_ago': now - self.checked if self.checked is not None else None
+            }
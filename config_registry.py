@@ -0,0 +1,188 @@
+import copy
+import hashlib
+import json
+import glob
+import os
+import re
+import threading
+
+import config_parser
+
+CONFIG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config')
+
+# Regex to match strings like x, qr_x, and x_min.
+RE_X = re.compile('(_|^)x(_|$)')
+RE_Y = re.compile('(_|^)y(_|$)')
+
+
+def scale_config_r(config, x_scale, y_scale, re_x, re_y):
+    """
+    Recursively scales lists within lists of values in the config dictionary
+    based on the width and height of the image being graded.
+
+    Args:
+        config (dict): An unscaled coordinate mapping read from the
+            configuration file.
+        x_scale (int): Factor to scale x coordinates by.
+        y_scale (int): Factor to scale y coordinates by.
+        re_x (pattern): Regex pattern to match x coordinate key names.
+        re_y (pattern): Regex pattern to match y coordinate key names.
+
+    """
+    for key, val in config.items():
+        if isinstance(val, list):
+            for config in val:
+                scale_config_r(config, x_scale, y_scale, re_x, re_y)
+        if re_x.search(key) or key == 'bubble_width':
+            config[key] = val * x_scale
+        elif re_y.search(key) or key == 'bubble_height':
+            config[key] = val * y_scale
+
+
+def scale_config(config, width, height):
+    """
+    Scales the values in the config dictionary in place based on the width and
+    height of the image being graded.
+
+    Args:
+        config (dict): An unscaled coordinate mapping read from the
+            configuration file.
+        width (int): Width of the actual test image.
+        height (int): Height of the actual test image.
+
+    """
+    x_scale = width / config['page_width']
+    y_scale = height / config['page_height']
+    scale_config_r(config, x_scale, y_scale, RE_X, RE_Y)
+
+
+class ConfigRegistry:
+    """
+    Process-wide cache of parsed and validated config files.
+
+    Each config is read, duplicate-key checked and parsed once and kept as a
+    template that is never handed out. Callers get their own deep copy, which
+    they are free to scale and mutate. A template is reloaded when the mtime
+    or size of its file changes.
+    """
+
+    def __init__(self, config_dir=CONFIG_DIR):
+        self.config_dir = config_dir
+        self._templates = {}
+        self._lock = threading.Lock()
+
+    def config_path(self, test, page_number):
+        return os.path.join(self.config_dir, f'{test}_page{page_number}.json')
+
+    def load(self, config_fname):
+        """
+        Returns the cached template for a config file, reading and validating
+        it again if the file changed since it was cached.
+
+        Args:
+            config_fname (str): Path to the config file.
+
+        Returns:
+            config (dict): The validated template or None if there was an error.
+            error (str): The error message or None if the config is valid.
+
+        """
+        try:
+            stat = os.stat(config_fname)
+        except FileNotFoundError:
+            return None, f'Configuration file {config_fname} not found'
+        file_version = (stat.st_mtime_ns, stat.st_size)
+
+        with self._lock:
+            cached = self._templates.get(config_fname)
+            if cached is not None and cached['version'] == file_version:
+                return cached['config'], cached['error']
+
+            # Read config file into dictionary. Check for duplicate keys with
+            # object pairs hook.
+            try:
+                with open(config_fname) as file:
+                    contents = file.read()
+            except FileNotFoundError:
+                return None, f'Configuration file {config_fname} not found'
+            config = json.loads(contents,
+                object_pairs_hook=config_parser.duplicate_key_check)
+
+            parser = config_parser.Parser(config, config_fname)
+            status, error = parser.parse()
+            if status == 1:
+                config = None
+            else:
+                error = None
+            self._templates[config_fname] = {
+                'version': file_version,
+                'digest': hashlib.sha256(contents.encode()).hexdigest(),
+                'config': config,
+                'error': error
+            }
+            return config, error
+
+    def preload(self):
+        """
+        Reads and validates every config in the config directory, so the
+        first page graded doesn't have to.
+
+        Returns:
+            errors (dict): The error message of each config file that isn't
+                valid.
+
+        """
+        errors = {}
+        for config_fname in sorted(glob.glob(os.path.join(self.config_dir, '*_page*.json'))):
+            _, error = self.load(config_fname)
+            if error is not None:
+                errors[config_fname] = error
+        return errors
+
+    def fingerprint(self, test, page_number):
+        """
+        Returns a hash of the contents of the config file for a test page, which
+        changes whenever the config does (unlike the mtime, it survives a deploy
+        that didn't touch the file).
+
+        Args:
+            test (str): Name of test (sat, act, etc)
+            page_number (int): Page number of test
+
+        Returns:
+            digest (str): The SHA-256 of the config file or None if there is no
+                such file.
+
+        """
+        config_fname = self.config_path(test, page_number)
+        self.load(config_fname)
+        with self._lock:
+            cached = self._templates.get(config_fname)
+            return cached['digest'] if cached is not None else None
+
+    def get(self, test, page_number, width=None, height=None):
+        """
+        Returns a private copy of the config for a test page, scaled to the
+        page size when width and height are given.
+
+        Args:
+            test (str): Name of test (sat, act, etc)
+            page_number (int): Page number of test
+            width (int): Width of the actual test image.
+            height (int): Height of the actual test image.
+
+        Returns:
+            config (dict): A copy of the config or None if there was an error.
+            error (str): The error message or None if the config is valid.
+
+        """
+        template, error = self.load(self.config_path(test, page_number))
+        if error is not None:
+            return None, error
+        config = copy.deepcopy(template)
+        if width is not None and height is not None:
+            scale_config(config, width, height)
+        return config, None
+
+
+registry = ConfigRegistry()
@@ -0,0 +1,67 @@
+import cv2 as cv
+import numpy as np
+
+
+class ContourFeatures:
+    """
+    Bounding boxes, point counts and centroids of a list of contours, computed for all of them
+    at once with numpy instead of one cv.boundingRect and np.mean at a time.
+    Ellipses are only fit for the contours that need them (see fit_ellipses), since
+    cv.fitEllipse can't be vectorized.
+    """
+    def __init__(self, contours):
+        """
+        Args:
+            contours (list): A list of contours in the form of np.array() (what cv.findContours returns).
+        """
+        self.contours = contours
+        self.size = len(contours)
+        self.counts = np.array([len(contour) for contour in contours], dtype=np.int64)
+        if self.size == 0:
+            empty = np.zeros(0, dtype=np.int64)
+            self.x, self.y, self.w, self.h = empty, empty, empty, empty
+            self.center_x, self.center_y = empty.astype(np.float64), empty.astype(np.float64)
+        else:
+            points = np.concatenate([contour.reshape(-1, 2) for contour in contours]).astype(np.int64)
+            starts = np.zeros(self.size, dtype=np.int64)
+            np.cumsum(self.counts[:-1], out=starts[1:])
+            xs = points[:, 0]
+            ys = points[:, 1]
+            # Same as cv.boundingRect for integer points.
+            self.x = np.minimum.reduceat(xs, starts)
+            self.y = np.minimum.reduceat(ys, starts)
+            self.w = np.maximum.reduceat(xs, starts) - self.x + 1
+            self.h = np.maximum.reduceat(ys, starts) - self.y + 1
+            # The mean of the contour points (not the centroid of the area they enclose).
+            self.center_x = np.add.reduceat(xs, starts) / self.counts
+            self.center_y = np.add.reduceat(ys, starts) / self.counts
+
+        # Filled in by fit_ellipses, nan for contours that don't have an ellipse (yet).
+        self.ellipse_x = np.full(self.size, np.nan)
+        self.ellipse_y = np.full(self.size, np.nan)
+        self.ellipse_w = np.full(self.size, np.nan)
+        self.ellipse_h = np.full(self.size, np.nan)
+        self.ellipse_angle = np.full(self.size, np.nan)
+
+    def fit_ellipses(self, mask):
+        """
+        Fits ellipses to the contours selected by mask that don't have one yet.
+
+        Args:
+            mask (numpy.ndarray): A boolean ndarray saying which contours need an ellipse.
+                They need at least 5 points.
+
+        """
+        for i in np.flatnonzero(mask & np.isnan(self.ellipse_angle)):
+            (x, y), (w, h), angle = cv.fitEllipse(self.contours[i])
+            self.ellipse_x[i] = x
+            self.ellipse_y[i] = y
+            self.ellipse_w[i] = w
+            self.ellipse_h[i] = h
+            self.ellipse_angle[i] = angle
+
+    def get_ellipse(self, i):
+        """
+        Returns the ellipse of contour i in the form cv.fitEllipse returns it.
+        """
+        return ((self.ellipse_x[i], self.ellipse_y[i]), (self.ellipse_w[i], self.ellipse_h[i]), self.ellipse_angle[i])
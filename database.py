@@ -0,0 +1,207 @@
+import json
+import os
+import queue
+import sqlite3
+import threading
+
+
+class Database:
+    """
+    Writes graded submissions to the database, reusing a small pool of connections per process
+    and sending all of a submission's answers in one batch. Subclasses connect to a particular
+    kind of database (see get_database).
+    """
+    def __init__(self, pool_size=None):
+        """
+        Args:
+            pool_size (int): How many idle connections to keep open. Defaults to the DB_POOL_SIZE
+                environment variable, or 2.
+        """
+        if pool_size is None:
+            pool_size = int(os.getenv('DB_POOL_SIZE', 2))
+        self.pool_size = max(1, pool_size)
+        self.lock = threading.Lock()
+        self.pid = None
+        self.pool = None
+
+    def connect(self):
+        raise NotImplementedError
+
+    def insert_submission(self, cursor, examinfo, submission_json):
+        """
+        Inserts the submission row and returns its Submission_ID.
+        """
+        raise NotImplementedError
+
+    def insert_answers(self, cursor, rows):
+        cursor.executemany("insert into Grader_Submissions_Answers "\
+                           "(Submission_ID, Test_Section, Test_Question_Number, Test_Question_Answer)" \
+                           " values (?,?,?,?)", rows)
+
+    def get_pool(self):
+        # A forked child (like a celery worker) can't use the parent's connections, so it starts its own pool.
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    self.pool = queue.LifoQueue()
+                    self.pid = os.getpid()
+        return self.pool
+
+    def is_alive(self, conn):
+        """
+        Checks that a pooled connection still works. The server (or a firewall) drops connections
+        that sit idle for too long, like between test days.
+        """
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT 1')
+            cursor.fetchall()
+            return True
+        except Exception:
+            return False
+
+    def get_connection(self):
+        pool = self.get_pool()
+        while True:
+            try:
+                conn = pool.get_nowait()
+            except queue.Empty:
+                return self.connect()
+            if self.is_alive(conn):
+                return conn
+            print('Dropping a pooled database connection that stopped working')
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    def release_connection(self, conn):
+        pool = self.get_pool()
+        if pool.qsize() < self.pool_size:
+            pool.put(conn)
+        else:
+            conn.close()
+
+    def upload_submission(self, examinfo, page_answers):
+        """
+        Inserts a submission and all of its answers in one transaction.
+
+        Args:
+            examinfo (dict): The submission (from handle_grader_message).
+            page_answers (dict): The answers for each section, {section: {question number: answer}}.
+
+        Returns:
+            submission_id (int): The Submission_ID of the new submission.
+
+        """
+        conn = self.get_connection()
+        try:
+            cursor = conn.cursor()
+            submission_id = self.insert_submission(cursor, examinfo, json.dumps(page_answers))
+            print(f'created subission id {submission_id}')
+            rows = [(submission_id, section, qnum, answer)
+                    for section, answers in page_answers.items()
+                    for qnum, answer in answers.items()]
+            print(f'Inserting {len(rows)} answers for sections {list(page_answers)} right meow')
+            if rows:
+                self.insert_answers(cursor, rows)
+            conn.commit()
+        except:
+            # We don't know what state the connection is in, so don't give it to anyone else.
+            try:
+                conn.rollback()
+            finally:
+                conn.close()
+            raise
+        self.release_connection(conn)
+        return submission_id
+
+
+class SqlServerDatabase(Database):
+    """
+    The production database, through pyodbc.
+    """
+    def connect(self):
+        import pyodbc
+        return pyodbc.connect('Driver={ODBC Driver 17 for SQL Server};'
+                              f'Server={os.getenv("DB_SERVER_NAME")};'
+                              f'Database={os.getenv("DB_NAME")};'
+                              f'UID={os.getenv("DB_USER")};'
+                              f'PWD={os.getenv("DB_PASSWORD")};'
+                              'Trusted_Connection=no;')
+
+    def insert_submission(self, cursor, examinfo, submission_json):
+        # SCOPE_IDENTITY (unlike @@IDENTITY) can't pick up an id made by a trigger, and doing it in the
+        # same batch saves a round trip. NOCOUNT keeps the row count from getting in front of the id.
+        cursor.execute("SET NOCOUNT ON; "\
+                       "insert into Grader_Submissions "\
+                       "(First_Name, Last_Name, Email_Address, Test_Type, Test_ID, Submission_JSON) "  \
+                       "values (?,?,?,?,?,?); "\
+                       "SELECT CAST(SCOPE_IDENTITY() AS int);", examinfo['First Name'], examinfo['Last Name'],
+                       examinfo['Email'], examinfo['Test'], examinfo['Test ID'], submission_json)
+        return int(cursor.fetchone()[0])
+
+    def insert_answers(self, cursor, rows):
+        # Sends all the rows in one round trip instead of one per row.
+        cursor.fast_executemany = True
+        super().insert_answers(cursor, rows)
+
+
+class SqliteDatabase(Database):
+    """
+    A local SQLite file with the same tables, for development and for benchmarking the database step.
+    """
+    def __init__(self, path=None, pool_size=None):
+        """
+        Args:
+            path (str): The SQLite file. Defaults to the DB_SQLITE_PATH environment variable, or grader.sqlite.
+            pool_size (int): See Database.
+        """
+        super().__init__(pool_size)
+        if path is None:
+            path = os.getenv('DB_SQLITE_PATH', 'grader.sqlite')
+        self.path = path
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("create table if not exists Grader_Submissions "\
+                     "(Submission_ID integer primary key autoincrement, First_Name text, Last_Name text, "\
+                     "Email_Address text, Test_Type text, Test_ID text, Submission_JSON text)")
+        conn.execute("create table if not exists Grader_Submissions_Answers "\
+                     "(Submission_ID integer, Test_Section text, Test_Question_Number text, Test_Question_Answer text)")
+        conn.commit()
+        return conn
+
+    def insert_submission(self, cursor, examinfo, submission_json):
+        cursor.execute("insert into Grader_Submissions "\
+                       "(First_Name, Last_Name, Email_Address, Test_Type, Test_ID, Submission_JSON) "  \
+                       "values (?,?,?,?,?,?)", (examinfo['First Name'], examinfo['Last Name'],
+                       examinfo['Email'], examinfo['Test'], examinfo['Test ID'], submission_json))
+        return cursor.lastrowid
+
+
+BACKENDS = {
+    'sqlserver': SqlServerDatabase,
+    'sqlite': SqliteDatabase
+}
+databases = {}
+databases_lock = threading.Lock()
+
+
+def get_database(backend=None):
+    """
+    Returns the process-wide Database for backend.
+
+    Args:
+        backend (str): 'sqlserver' or 'sqlite'. Defaults to the DB_BACKEND environment variable, or 'sqlserver'.
+
+    Returns:
+        Database: The database to upload submissions to.
+
+    """
+    if backend is None:
+        backend = os.getenv('DB_BACKEND', 'sqlserver')
+    with databases_lock:
+        if backend not in databases:
+            databases[backend] = BACKENDS[backend]()
+        return databases[backend]
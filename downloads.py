@@ -0,0 +1,124 @@
+import io
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Bytes read from the response at a time.
+CHUNK_SIZE = 1024 * 1024
+
+
+class Downloader:
+    """
+    Downloads the images of a submission over one pooled requests.Session per process,
+    a few at a time, with timeouts and retries (with backoff) for connection errors
+    and 429/5xx responses.
+    """
+    def __init__(self, workers=None, timeout=None, retries=None):
+        """
+        Args:
+            workers (int): How many images to download at the same time. Defaults to the
+                DOWNLOAD_WORKERS environment variable, or 4.
+            timeout (float): Seconds to wait to connect and between bytes of the response.
+                Defaults to the DOWNLOAD_TIMEOUT environment variable, or 30.
+            retries (int): How many times to retry a failed download. Defaults to the
+                DOWNLOAD_RETRIES environment variable, or 3.
+        """
+        if workers is None:
+            workers = int(os.getenv('DOWNLOAD_WORKERS', 4))
+        if timeout is None:
+            timeout = float(os.getenv('DOWNLOAD_TIMEOUT', 30))
+        if retries is None:
+            retries = int(os.getenv('DOWNLOAD_RETRIES', 3))
+        self.workers = max(1, workers)
+        self.timeout = timeout
+        self.retries = retries
+        self.lock = threading.Lock()
+        self.pid = None
+        self.session = None
+
+    def get_session(self):
+        """
+        Returns the session for this process. A forked child (like a celery worker) makes its
+        own, since it can't share the parent's connections.
+        """
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    retry = Retry(total=self.retries, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504],
+                                  allowed_methods=['GET'], raise_on_status=False)
+                    adapter = HTTPAdapter(pool_connections=self.workers, pool_maxsize=self.workers, max_retries=retry)
+                    session = requests.Session()
+                    session.mount('http://', adapter)
+                    session.mount('https://', adapter)
+                    self.session = session
+                    self.pid = os.getpid()
+        return self.session
+
+    def download_image(self, imgurl, imgfile):
+        """
+        Downloads imgurl and writes it into imgfile.
+
+        Args:
+            imgurl (str): The url of the image.
+            imgfile (file): A file opened for writing in binary mode.
+
+        Returns:
+            bool: True if the image was downloaded, False otherwise.
+
+        """
+        try:
+            with self.get_session().get(imgurl, stream=True, timeout=self.timeout) as r:
+                if r.status_code != 200:
+                    print(f'Downloading {imgurl} failed with status {r.status_code}')
+                    return False
+                for block in r.iter_content(CHUNK_SIZE):
+                    imgfile.write(block)
+        except requests.RequestException as e:
+            print(f'Downloading {imgurl} failed: {e}')
+            return False
+        imgfile.flush()
+        return True
+
+    def download_bytes(self, imgurl):
+        """
+        Downloads imgurl into memory.
+
+        Returns:
+            bytes: The contents of the image, or None if the download failed.
+        """
+        imgbuffer = io.BytesIO()
+        if self.download_image(imgurl, imgbuffer):
+            return imgbuffer.getvalue()
+        return None
+
+    def download_images(self, imgurls):
+        """
+        Starts downloading all of imgurls at once (up to self.workers at a time) and yields them
+        in order as they finish, so the first page can be graded while the rest are still
+        downloading. Downloads that haven't started when the caller stops iterating are cancelled.
+
+        Args:
+            imgurls (list): The urls of the images, in page order.
+
+        Yields:
+            (imgurl, imgbytes): The url and the contents of the image, or None if the download failed.
+
+        """
+        executor = ThreadPoolExecutor(max_workers=min(self.workers, max(1, len(imgurls))))
+        futures = []
+        try:
+            futures = [executor.submit(self.download_bytes, imgurl) for imgurl in imgurls]
+            for imgurl, future in zip(imgurls, futures):
+                yield imgurl, future.result()
+        finally:
+            # shutdown(cancel_futures=True) is Python 3.9+, so cancel what hasn't started ourselves.
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+
+downloader = Downloader()
@@ -1,6 +1,5 @@
 import click
 import grader as g
-import json
 
 @click.command()
 @click.option('--test', type=click.Choice(['SAT', 'ACT']), default='SAT', help='test to grade', required=True)
@@ -12,9 +11,11 @@ def dreadnought(test, page, box, imgpath):
     """ 
     """
     grader = g.Grader()
-    jsonData = grader.grade(imgpath, False, False, 1.0, test.lower(), box, page)
-    data = json.loads(jsonData)
-    print(data['answer']['bubbled'])
+    result = grader.grade_page(imgpath, False, False, 1.0, test.lower(), page)
+    if box > len(result.boxes):
+        print(f'Box {box} was not graded ({len(result.boxes)} boxes were): {result.error}')
+        return
+    print(result.boxes[box - 1].bubbled)
 
 if __name__ == '__main__':
     dreadnought()
@@ -0,0 +1,64 @@
+import os
+import threading
+
+import jinja2
+import yaml
+
+EMAIL_MESSAGES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'email_messages.yml')
+
+
+class EmailTemplates:
+    """
+    The subject and body templates of every email in email_messages.yml. The file is parsed and
+    compiled once, and again only when it changes on disk, so rendering an email just renders its
+    own two templates. The variables (like the student's name) go into the rendered text, never
+    into the YAML, so they can't change how the file is parsed.
+    """
+    def __init__(self, path=EMAIL_MESSAGES_FILE):
+        self.path = path
+        # Block scalars (body: |) end with a newline, and jinja would drop it by default.
+        self.environment = jinja2.Environment(keep_trailing_newline=True)
+        self.lock = threading.Lock()
+        self.mtime = None
+        self.templates = {}
+
+    def get_templates(self):
+        """
+        Returns:
+            templates (dict): {email tag: (subject template, body template)}, reloaded if the file changed.
+        """
+        mtime = os.stat(self.path).st_mtime_ns
+        if mtime != self.mtime:
+            with self.lock:
+                if mtime != self.mtime:
+                    with open(self.path) as yaml_file:
+                        email_config = yaml.safe_load(yaml_file)
+                    self.templates = {tag: (self.environment.from_string(str(email['subject'])),
+                                            self.environment.from_string(str(email['body'])))
+                                      for tag, email in email_config.items()}
+                    self.mtime = mtime
+        return self.templates
+
+    def __contains__(self, email_tag):
+        return email_tag in self.get_templates()
+
+    def render(self, email_tag, email_variables):
+        """
+        Renders one email.
+
+        Args:
+            email_tag (str): a tag that identifies which email to take
+            email_variables (dict): Variables we need to replace (e.g. {{name}} and {{test}})
+
+        Returns:
+            subject (str), body (str): The email, ready to send.
+
+        Raises:
+            KeyError: If there is no email called email_tag.
+
+        """
+        subject, body = self.get_templates()[email_tag]
+        return subject.render(email_variables), body.render(email_variables)
+
+
+email_templates = EmailTemplates()
@@ -1,20 +1,72 @@
 import os
 import sys
 import argparse
-import json
-import re
+import bisect
 import cv2 as cv
 from imutils.perspective import four_point_transform
 import numpy as np
-import config_parser
+import config_registry
+import contextvars
+import functools
+import instrumentation
+import line_fitting
+from results import BoxResult, PageResult, Status
+import threading
 from collections import deque
-from test_box import TestBox
+from concurrent.futures import ThreadPoolExecutor
+from test_box import BoxLocator, TestBox
 import utils
 
 
+class PreprocessedImage:
+    """
+    The grayscale version of a test image and the threshold family for it. 
+    These don't depend on the threshold constant, so we compute them once per image
+    and share them between all the constants find_page tries.
+    """
+    def __init__(self, im):
+        """
+        Args:
+            im (numpy.ndarray): An ndarray representing the entire test image.
+        """
+        self.im = im
+        self.gray = cv.cvtColor(im, cv.COLOR_BGR2GRAY)
+        self.thresholds = utils.ThresholdFamily(self.gray)
+
+
+# cv.imread flags for decoding a JPEG at 1/2, 1/4 or 1/8 of its size.
+REDUCED_READ_FLAGS = {1: cv.IMREAD_COLOR, 2: cv.IMREAD_REDUCED_COLOR_2, 4: cv.IMREAD_REDUCED_COLOR_4, 8: cv.IMREAD_REDUCED_COLOR_8}
+
+
 class Grader:
-    def __init__(self):
+    # How many of the biggest contours on a page are considered when looking for line contours.
+    LINE_CONTOUR_CANDIDATES = 20
+
+    def __init__(self, threshold_workers=None, working_resolution=None, max_image_pixels=None, timings=None):
+        """
+        Args:
+            threshold_workers (int): How many page threshold constants to try at the same time. 
+                Defaults to the GRADER_THRESHOLD_WORKERS environment variable, or 1 (one at a time).
+            working_resolution (int): Images with a longer side than this (in pixels) are shrunk to it 
+                before grading. Defaults to the GRADER_WORKING_RESOLUTION environment variable, or 0 (never shrink).
+            max_image_pixels (int): The most pixels an image is decoded to; bigger images are shrunk to fit.
+                Defaults to the GRADER_MAX_IMAGE_PIXELS environment variable, or 0 (no limit).
+            timings (bool): True to time the grading stages and add them to the result as 'timings'.
+                Defaults to the GRADER_TIMINGS environment variable, or False.
+        """
         self.config = None
+        if threshold_workers is None:
+            threshold_workers = int(os.getenv('GRADER_THRESHOLD_WORKERS', 1))
+        self.threshold_workers = threshold_workers
+        if working_resolution is None:
+            working_resolution = int(os.getenv('GRADER_WORKING_RESOLUTION', 0))
+        self.working_resolution = working_resolution
+        if max_image_pixels is None:
+            max_image_pixels = int(os.getenv('GRADER_MAX_IMAGE_PIXELS', 0))
+        self.max_image_pixels = max_image_pixels
+        if timings is None:
+            timings = bool(int(os.getenv('GRADER_TIMINGS', 0)))
+        self.timings = timings
 
 
     def get_contour_width(self, contour):
@@ -35,28 +87,10 @@ class Grader:
         Gets the first and last points of the contour it is passed 
         ("xy" decides whether it sorts by x or y)
         """
-        min_x = [np.inf, 0]
-        max_x = [-1, 0]
-        min_y = [0, np.inf]
-        max_y = [0, -1]
-        
-        for point in contour:
-            px = point[0][0]
-            py = point[0][1]
-            if py < min_y[1]:
-                min_y = [px, py]
-            if px < min_x[0]:
-                min_x = [px, py]
-            if py > max_y[1]:
-                max_y = [px, py]
-            if px > max_x[0]:
-                max_x = [px, py]
-        if xy == 'x':
-            return min_x[0], min_x[1], max_x[0], max_x[1]
-        if xy == 'y':
-            return min_y[0], min_y[1], max_y[0], max_y[1]
-
-    def find_page(self, im, test, debug_mode, threshold_constant):
+        return line_fitting.get_first_and_last_points(contour, xy)
+
+    @instrumentation.stage('find_page')
+    def find_page(self, im, test, debug_mode, threshold_constant, preprocessed=None, config=None):
         """
         Finds and returns the outside box that contains the entire test. 
         We will use this to scale the given image.
@@ -67,14 +101,20 @@ class Grader:
             debug_mode (boolean): Whether or not we should show images or print in print statements
             threshold_constant (float): What threshold his to be used in the get_threshold function call. 
             P.S. We are looping through many different ones
+            preprocessed (PreprocessedImage): The grayscale and threshold family of im, 
+                so they can be shared between threshold constants. Computed here if not passed.
+            config (dict): The unscaled config for this page. Defaults to self.config.
         Returns:
             numpy.ndarray: An ndarray representing the test box in the image.
 
         """
         # Convert image to grayscale then blur to better detect contours.
         page = None
-        imgray = cv.cvtColor(im, cv.COLOR_BGR2GRAY)
-        threshold = utils.get_threshold(imgray, threshold_constant)
+        if preprocessed is None:
+            preprocessed = PreprocessedImage(im)
+        # We draw on imgray below, so we need our own copy of the shared grayscale image.
+        imgray = preprocessed.gray.copy()
+        threshold = preprocessed.thresholds.threshold(threshold_constant)
         if debug_mode:
             cv.imshow('', threshold)
             cv.waitKey()    
@@ -101,7 +141,7 @@ class Grader:
             and find the one with the largest y position (closest to the bottom) 
             that is at least 80% of the first 6 minimum line we calculated before
             """
-            line_contours = self.get_line_contours(contours[:20], imgray, 6, 6)
+            line_contours = self.get_line_contours(contours[:self.LINE_CONTOUR_CANDIDATES], imgray, 6, 6)
             
             
             b1x, b1y, b2x, b2y = self.get_first_and_last_points(line_contours[0], 'x')
@@ -140,49 +180,60 @@ class Grader:
             cv.imshow('', transformed_image)
             cv.waitKey()
         if test == 'act':
-            transformed_image = self.act_draw_boxes(transformed_image, threshold_constant)
+            transformed_image = self.act_draw_boxes(transformed_image, threshold_constant, config)
         return transformed_image
 
+    def lines_can_merge(self, cp, cp2, x_threshold, y_threshold):
+        """
+        Checks whether two line contours look like pieces of the same line.
+        """
+        # We will merge contours only if:
+        # the slopes of cp and cp2 are similar
+        # the first y positions are similar
+        # they have about the same starting and ending x's
+        return np.abs(cp['slope'] - cp2['slope']) < 0.01 and \
+               np.abs(cp['first_point'][1] - cp2['first_point'][1]) < y_threshold and \
+               np.abs(cp['first_point'][0] - cp2['first_point'][0]) < x_threshold and \
+               np.abs(cp['last_point'][0] - cp2['last_point'][0]) < x_threshold
+
     def merge_lines(self, contour_properties, imgray):
         """
         Goes through all the contour_properties and checks for lines that have similar slope
         and are ending and starting at about the same place. 
+        Each contour is merged with the first contour after it that matches (which is then 
+        dropped), unless it was already dropped itself. Only contours whose first points are 
+        within y_threshold of each other can match, so instead of comparing every pair we sort 
+        the contours by first y and only compare each one with its neighbours in that order.
         """
-        clean_contour_properties = []
         page_height, page_width = imgray.shape
         y_threshold = 0.007*page_height
         x_threshold = 0.1*page_width
+        first_ys = [cp['first_point'][1] for cp in contour_properties]
+        by_y = sorted(range(len(contour_properties)), key=lambda i: first_ys[i])
+        sorted_ys = [first_ys[i] for i in by_y]
+        ignored = [False] * len(contour_properties)
+        clean_contour_properties = []
         for i, cp in enumerate(contour_properties):
-            merged = False
-            if 'ignored' in cp:
+            # If it is a partner of a line that was already merged, we drop it
+            if ignored[i]:
                 continue
-            for cp2 in contour_properties[i+1:]:
-                # We will merge contours only if:
-                # the slopes of cp and cp2 are similar
-                # the first y positions are similar
-                # they have about the same starting and ending x's
-                if np.abs(cp['slope'] - cp2['slope']) < 0.01 and \
-                   np.abs(cp['first_point'][1] - cp2['first_point'][1]) < y_threshold and \
-                   np.abs(cp['first_point'][0] - cp2['first_point'][0]) < x_threshold and \
-                   np.abs(cp['last_point'][0] - cp2['last_point'][0]) < x_threshold:
-                        clean_contour_properties.append(cp)
-                        cp2['ignored'] = True
-                        merged = True
-                        break
-            # If cp didn't get a merge partner then its still a potential line contour. 
-            # If it did find one, we already broke out and will never get here
-            # If it is a partner of a line that was already merged, we already got rid of it above
-            if not merged:
-                clean_contour_properties.append(cp)
+            # The contours that could match are in by_y[lo:hi] (with a pixel to spare, 
+            # lines_can_merge has the final say).
+            lo = bisect.bisect_left(sorted_ys, first_ys[i] - y_threshold - 1)
+            hi = bisect.bisect_right(sorted_ys, first_ys[i] + y_threshold + 1)
+            partner = None
+            for j in by_y[lo:hi]:
+                if j > i and (partner is None or j < partner) and \
+                   self.lines_can_merge(cp, contour_properties[j], x_threshold, y_threshold):
+                    partner = j
+            if partner is not None:
+                ignored[partner] = True
+            # Whether or not cp got a merge partner, it's still a potential line contour. 
+            clean_contour_properties.append(cp)
         return clean_contour_properties
 
-    def get_line_contour_y(self, line_contour):
-        """
-        Gets the y position of a line contour by finding the median y of all the points.
-        """
-        return np.median([p[0][1] for p in line_contour])
-        
-    def act_draw_boxes(self, image, threshold_constant):
+    @instrumentation.stage('act_draw_boxes')
+    def act_draw_boxes(self, image, threshold_constant, config=None):
         """
         Converts top and bottom lines into boxes and draws them onto the page.
         """
@@ -192,29 +243,32 @@ class Grader:
         contours, _ = cv.findContours(threshold, cv.RETR_EXTERNAL, 
             cv.CHAIN_APPROX_SIMPLE)
         contours = self.sort_contours_by_width(contours)
-        line_contours = sorted(self.get_line_contours(contours[:20], image, 5, 6), key=lambda y: self.get_line_contour_y(y), reverse=False)
+        # Already sorted by y, and we get their ys so we don't have to find the medians again.
+        line_contours, line_ys = self.find_line_contours(contours[:self.LINE_CONTOUR_CANDIDATES], image, 5, 6)
         
         # colorim = cv.cvtColor(image, cv.COLOR_GRAY2BGR)
         # cv.drawContours(colorim,line_contours, -1, (133,255,255), 3)
         # cv.imshow('', colorim)
         # cv.waitKey()
         # we add one because we don't grade the first box
-        num_expected_boxes = len(self.config['boxes'])  
+        if config is None:
+            config = self.config
+        num_expected_boxes = len(config['boxes'])  
         h, w = image.shape
         min_box_height = (h/num_expected_boxes+1)/2
-        prev_contour = line_contours[0]
+        prev_y = line_ys[0]
         boxes_to_draw = deque()
 
         areas_to_erase = []
         x = 1
-        for c in line_contours:
+        for y in line_ys:
             # calculating height by finding difference beween y values.
-            current_box_height = self.get_line_contour_y(c) - self.get_line_contour_y(prev_contour)
+            current_box_height = y - prev_y
             erase_height = int(h*0.013)
             line_separation = round(h*0.0034)
             if current_box_height > min_box_height:
-                ty = self.get_line_contour_y(prev_contour)
-                by = self.get_line_contour_y(c)
+                ty = prev_y
+                by = y
                 boxes_to_draw.append(np.array(([x, ty+line_separation],
                                                [w-1, ty+line_separation],
                                                [w-1, by-line_separation],
@@ -222,7 +276,7 @@ class Grader:
                                               dtype=np.int32))
                 areas_to_erase.append(np.array(([x, ty-erase_height], [w-1, ty-erase_height],
                                                 [w-1, ty+erase_height], [x, ty+erase_height]), dtype=np.int32))
-            prev_contour = c
+            prev_y = y
         # Make sure that theres a box at the top of the page
         top_box_y_pos = boxes_to_draw[0][0][1]
         bottom_y_pos = boxes_to_draw[-1][-1][1]
@@ -241,29 +295,6 @@ class Grader:
         cv.drawContours(image, boxes_to_draw, -1, 0, 1)
         return image
 
-    def get_contour_properties(self, contour):
-        """
-        Gets the first point, last point, slope, intercept, width, height, and 
-        the np.array of the contour pased
-        """
-        _x, _y, w, h = cv.boundingRect(contour)
-        xs = [p[0][0] for p in contour]
-        ys = [p[0][1] for p in contour]
-        m,b = np.polyfit(xs,ys,1)
-        sorted_contour = sorted(contour, key=lambda p: p[0][0], reverse = False)
-        first_point = sorted_contour[0][0]
-        last_point = sorted_contour[-1][0]
-        
-        return {
-                'first_point': first_point, 
-                'last_point': last_point,
-                'slope': m,
-                'intercept': b,
-                'width': w,
-                'height': h,
-                'contour': contour
-               }
-
     def get_line_contours(self, contours, imgray, min_cnum, max_cnum):
         """
         Goes through the list of contours and decides whether they are lines. 
@@ -274,33 +305,33 @@ class Grader:
             min_cnum (int): The minimum number of contours to return
             max_cnum (int): The maximum number of contours to return 
         Returns:
-            line_contours (list): A list of line contours
+            line_contours (list): A list of line contours, sorted by y position
+        """
+        line_contours, _ = self.find_line_contours(contours, imgray, min_cnum, max_cnum)
+        return line_contours
+
+    def find_line_contours(self, contours, imgray, min_cnum, max_cnum):
+        """
+        Same as get_line_contours, but also returns the y position of every line contour 
+        (the median y of its points), which we already have.
+
+        Returns:
+            line_contours (list): A list of line contours, sorted by y position
+            line_ys (list): The y position of each line contour
         """
-        line_contours = []
         if len(contours) < min_cnum:
             raise Exception('We could not find the detailed features in your image. Please send an image that has a high enough resolution')
+        # Fit a line to every contour at once, and find how far each contour's points are from its line.
+        features = line_fitting.LineFeatures(contours)
         contour_properties = []
-        # We are looping through the contours that are sorted by y position. 
-        # keeps only those that are about right length
-        for contour in contours:
-            contour_properties.append(self.get_contour_properties(contour))
-        for properties in contour_properties:
-            deviations = []
-            slope = properties['slope']
-            first_point = properties['first_point']
-            for point in properties['contour']:
-                point_x = point[0][0]
-                point_y = point[0][1]
-                pred_y = slope * point_x + properties['intercept']
-                deviations.append(np.abs(point_y-pred_y))
-            
-            average_deviation = np.average(deviations)
-            median_deviation = np.median(deviations)
-            #print(average_deviation)
-            properties['average_deviation'] = average_deviation
-            properties['median_deviation'] = median_deviation
-            properties['deviations'] = deviations
-            properties['height'] = median_deviation*2
+        for i in range(features.size):
+            properties = features.get_properties(i)
+            properties['average_deviation'] = features.average_deviation[i]
+            properties['median_deviation'] = features.median_deviation[i]
+            properties['deviations'] = features.get_deviations(i)
+            properties['height'] = features.median_deviation[i]*2
+            properties['y'] = features.median_y[i]
+            contour_properties.append(properties)
                 
         # colorim = cv.cvtColor(imgray, cv.COLOR_GRAY2BGR)
         # cv.drawContours(colorim,[cp['contour'] for cp in contour_properties], -1, (133,255,255), 3)
@@ -315,6 +346,7 @@ class Grader:
             if cp['average_deviation'] < 50:
                 plausable_line_properties.append(cp)
 
+        line_properties = []
         line_widths = []
         plausable_line_properties = self.merge_lines(plausable_line_properties, imgray)
         longest_line_properties = sorted(plausable_line_properties, key=lambda cp: cp['width'], reverse = True)[:6]
@@ -323,18 +355,18 @@ class Grader:
         median_height = np.median([cp['height'] for cp in longest_line_properties])
         # Now that we've finished merging, we are free to check heights and deviations
         for cp in plausable_line_properties:
-            c = cp['contour']
             w = cp['width']
             if cp['height'] < median_height*4 and \
                w >= min_line_length and w <= max_line_length:
-                line_contours.append(c)
+                line_properties.append(cp)
                 line_widths.append(w)
                 
-        if len(line_contours) < min_cnum or len(line_contours) > max_cnum:
+        if len(line_properties) < min_cnum or len(line_properties) > max_cnum:
             #find contours with similar slopes and merge them
             raise Exception(f"We couldn't find the right amount lines between the test sections to indentify where the bubbles are. We found these widths {line_widths}")
 
-        return sorted(line_contours, key=lambda a: self.get_line_contour_y(a), reverse = False)
+        line_properties = sorted(line_properties, key=lambda cp: cp['y'], reverse = False)
+        return [cp['contour'] for cp in line_properties], [cp['y'] for cp in line_properties]
 
     def image_is_upright(self, page, config):
         """
@@ -373,33 +405,6 @@ class Grader:
                     return page
         return None
 
-    def scale_config_r(self, config, x_scale, y_scale, re_x, re_y):
-        """
-        Recursively scales lists within lists of values in the config dictionary 
-        based on the width and height of the image being graded.  
-
-        Args:
-            config (dict): An unscaled coordinate mapping read from the 
-                configuration file.
-            x_scale (int): Factor to scale x coordinates by.
-            y_scale (int): Factor to scale y coordinates by.
-            re_x (pattern): Regex pattern to match x coordinate key names.
-            re_y (pattern): Regex pattern to match y coordinate key names.
-
-        Returns:
-            config (dict): A scaled coordinate mapping read from the 
-                configuration file. 
-
-        """
-        for key, val in config.items():
-            if isinstance(val, list):
-                for config in val:
-                    self.scale_config_r(config, x_scale, y_scale, re_x, re_y)
-            if re_x.search(key) or key == 'bubble_width':
-                config[key] = val * x_scale
-            elif re_y.search(key) or key == 'bubble_height':
-                config[key] = val * y_scale
-
     def scale_config(self, config, width, height):
         """
         Scales the values in the config dictionary based on the width and height
@@ -412,60 +417,250 @@ class Grader:
             height (int): Height of the actual test image.
 
         """
-        x_scale = width / config['page_width']
-        y_scale = height / config['page_height']
-
-        # Regex to match strings like x, qr_x, and x_min.
-        re_x = re.compile('(_|^)x(_|$)')
-        re_y = re.compile('(_|^)y(_|$)')
-        
-        self.scale_config_r(config, x_scale, y_scale, re_x, re_y)
+        config_registry.scale_config(config, width, height)
     
-    def format_error(self, data):
-        return json.dumps(data)
+    def finish_result(self, result):
+        """
+        Adds the timings we recorded (if we are recording) to result and returns it.
+        """
+        timings = instrumentation.get_timings()
+        if timings is not None:
+            result.timings = timings.to_dict()
+        return result
 
-    def initialize_config(self, test, page_number):
+    def get_decode_reduction(self, width, height):
         """
-        Uses the config parser file to unpack the config file into self.config
+        Picks how much to shrink an image while decoding it (1, 2, 4 or 8). 
+        It shrinks as much as it can without going below the working resolution, and at least 
+        enough to fit in max_image_pixels.
+
+        Args:
+            width (int): Width of the image file.
+            height (int): Height of the image file.
+
+        Returns:
+            int: The reduction factor.
+
         """
-        #Identify configuration file  
-        config_fname = (os.path.dirname(os.path.abspath(__file__)) 
-        + f'/config/{test}_page{page_number}.json')
+        reduction = 1
+        if self.working_resolution:
+            for factor in (2, 4, 8):
+                if max(width, height) / factor >= self.working_resolution:
+                    reduction = factor
+        if self.max_image_pixels:
+            for factor in (1, 2, 4, 8):
+                if factor >= reduction and (width / factor) * (height / factor) <= self.max_image_pixels:
+                    break
+            reduction = max(reduction, factor)
+        return reduction
 
+    def get_working_size_factor(self, im):
+        """
+        Returns the factor to resize a decoded image by so it fits the working resolution and
+        max_image_pixels (1 if it already does).
+        """
+        height, width = im.shape[:2]
+        factor = 1.0
+        if self.working_resolution and max(width, height) > self.working_resolution:
+            factor = self.working_resolution / max(width, height)
+        if self.max_image_pixels and width * height > self.max_image_pixels:
+            factor = min(factor, (self.max_image_pixels / (width * height)) ** 0.5)
+        return factor
 
-        # Read config file into dictionary and scale values. Check for duplicate
-        # keys with object pairs hook.
-        try:
-            with open(config_fname) as file:
-                config = json.load(file, 
-                    object_pairs_hook=config_parser.duplicate_key_check)
-        except FileNotFoundError:
-            return f'Configuration file {config_fname} not found'
-
-        # Parse config file.
-        parser = config_parser.Parser(config, config_fname)
-        self.config =  config
-        status, error = parser.parse()
-        if status == 1:
-            return error 
+    @instrumentation.stage('load_image')
+    def load_image(self, image):
+        """
+        Loads the test image at the working resolution. JPEGs that are much bigger than the 
+        working resolution are decoded at a reduced size to begin with, then the image is 
+        shrunk the rest of the way with INTER_AREA. If neither working_resolution nor 
+        max_image_pixels is set, this is just cv.imread (or cv.imdecode). Either way the 
+        image is turned upright according to its EXIF orientation, like cv.imread does.
 
-        return None
+        Args:
+            image (str, bytes or numpy.ndarray): Filepath to the test image, the contents of the 
+                image file, or the decoded (BGR or grayscale) image.
+
+        Returns:
+            im (numpy.ndarray): The test image at the working resolution, or None if it couldn't be read.
+            original_size (tuple): The (width, height) of the image file.
+
+        """
+        original_size = None
+        if isinstance(image, np.ndarray):
+            im = image if image.ndim == 3 else cv.cvtColor(image, cv.COLOR_GRAY2BGR)
+        else:
+            reduction = 1
+            orientation = utils.get_exif_orientation(image)
+            if self.working_resolution or self.max_image_pixels:
+                original_size = utils.get_image_size(image)
+                if original_size is not None:
+                    reduction = self.get_decode_reduction(*original_size)
+                    if orientation >= 5:
+                        # The image is turned on its side when we make it upright.
+                        original_size = original_size[::-1]
+            if isinstance(image, str):
+                im = cv.imread(image, REDUCED_READ_FLAGS[reduction])
+            else:
+                # Not every OpenCV version applies the EXIF orientation in imdecode like imread does,
+                # so we always skip it there and do it ourselves.
+                im = cv.imdecode(np.frombuffer(image, dtype=np.uint8), 
+                                 REDUCED_READ_FLAGS[reduction] | cv.IMREAD_IGNORE_ORIENTATION)
+                if im is not None:
+                    im = utils.apply_exif_orientation(im, orientation)
+        if im is None:
+            return None, None
+        if original_size is None:
+            original_size = (im.shape[1], im.shape[0])
+        factor = self.get_working_size_factor(im)
+        if factor < 1:
+            size = (max(1, round(im.shape[1] * factor)), max(1, round(im.shape[0] * factor)))
+            im = cv.resize(im, size, interpolation=cv.INTER_AREA)
+        return im, original_size
 
     def initialize_return_data(self):
         """
-        Initializes the data structure we use to return answers and errors/statuses.
+        Initializes the PageResult we use to return answers and errors/statuses.
         """
-        data = {
-            'status' : 0,
-            'error' : '',
-            'boxes' : []
+        return PageResult()
+
+    @instrumentation.stage('grade_threshold')
+    def grade_threshold(self, preprocessed, test, page_number, threshold_constant, image_name, 
+                        verbose_mode, debug_mode, scale, url, cancelled=None):
+        """
+        Finds the page with one threshold constant and grades every box on it.
+
+        Args:
+            preprocessed (PreprocessedImage): The test image and its grayscale and threshold family.
+            test (str): Name of test
+            page_number (int): Page number of test
+            threshold_constant (float): The threshold constant used to find the page.
+            image_name (str): Filepath to the test image (used in error messages).
+            verbose_mode (bool): True to run program in verbose mode, False 
+                otherwise.
+            debug_mode (bool): True to run program in debug mode, False 
+                otherwise.
+            scale (float): Factor to scale image slices by.
+            url (str): The url for the image being graded (used for logging).
+            cancelled (threading.Event): Set when a better attempt already graded the page 
+                and this one can stop early.
+        Returns:
+            attempt (dict): The PageResult for this attempt ('result'), the page and config it used,
+                whether it graded every box ('success') and whether grade should return 
+                its data right away ('finished').
+        """
+        instrumentation.count('page_threshold_attempts')
+        attempt = {
+            'result': self.initialize_return_data(),
+            'config': None,
+            'page': None,
+            'page_found': False,
+            'success': False,
+            'finished': False
         }
-        return data
+        result = attempt['result']
+        try:
+            config, config_error = config_registry.registry.get(test, page_number)
+            if config_error is not None:
+                result.set_error(Status.ADMIN_ERROR, config_error)
+                attempt['finished'] = True
+                return attempt
+            attempt['config'] = config
+            if cancelled is not None and cancelled.is_set():
+                return attempt
+            page = self.find_page(preprocessed.im, test, debug_mode, threshold_constant, preprocessed, config)
+        except Exception as e:
+            print(f"Unable to find page: {str(e)} at threshold {threshold_constant}.")
+            return attempt
+        attempt['page_found'] = True
+        if page is not None:
+            # Scale config values based on page size.
+            self.scale_config(config, page.shape[1], page.shape[0])
+            # Rotate page until upright.
+            page = self.upright_image(page, config)
+            if page is None:
+                result.set_error(Status.BOX_ERROR, f'Could not upright page in {image_name}')
+                attempt['finished'] = True
+                return attempt
+
+            # Grade each test box and add it to result. The boxes share one locator so the 
+            # boxes on the page are only found once.
+            box_locator = BoxLocator(page, threshold_constant)
+            for box_num, box_config in enumerate(config['boxes']):  
+                if cancelled is not None and cancelled.is_set():
+                    break
+                #For debugging purposes: if box_num != 3: continue
+                box_config['x_error'] = config['x_error']
+                box_config['y_error'] = config['y_error']
+                box_config['bubble_width'] = config['bubble_width']
+                box_config['bubble_height'] = config['bubble_height']
+                box_config['min_bubbles_per_box'] = config['min_bubbles_per_box']
+                box_config['box_to_grade'] = config['box_to_grade']
+
+                box = TestBox(page, box_config, verbose_mode, debug_mode, scale, test, threshold_constant, url, box_locator) #make cleaner with new lines
+                results = box.grade(page_number, box_num)
+                if box.status == 0:
+                    result.boxes.append(BoxResult(box.name, results, Status(box.status), box.error))
+                else:
+                    break
+            successful_boxes = 0
+            for box in result.boxes:
+                if box.status == Status.SUCCESS:
+                    successful_boxes+=1
+            attempt['success'] = successful_boxes == len(config['boxes'])
+        attempt['page'] = page
+        return attempt
+
+    def grade_thresholds(self, preprocessed, test, page_number, threshold_list, image_name, 
+                         verbose_mode, debug_mode, scale, url):
+        """
+        Yields (threshold_constant, attempt) for each threshold constant in order, 
+        only grading the next constant when the caller asks for it.
+        """
+        for threshold_constant in threshold_list:
+            yield threshold_constant, self.grade_threshold(preprocessed, test, page_number, threshold_constant,
+                                                           image_name, verbose_mode, debug_mode, scale, url)
+
+    def grade_thresholds_concurrently(self, preprocessed, test, page_number, threshold_list, image_name, 
+                                      verbose_mode, debug_mode, scale, url):
+        """
+        Grades the threshold constants on a pool of self.threshold_workers threads and yields 
+        (threshold_constant, attempt) in the order of threshold_list, like grade_thresholds.
+        As soon as an attempt grades every box, the attempts for the constants after it are 
+        cancelled, since we would never use them.
+        """
+        cancel_events = [threading.Event() for _ in threshold_list]
+        workers = min(self.threshold_workers, len(threshold_list))
+
+        def cancel_after(index):
+            for event in cancel_events[index+1:]:
+                event.set()
+            for future in futures[index+1:]:
+                future.cancel()
+
+        def attempt_done(index, future):
+            if not future.cancelled() and future.exception() is None and future.result()['success']:
+                cancel_after(index)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = []
+            for threshold_constant, cancelled in zip(threshold_list, cancel_events):
+                # Each attempt runs in a copy of our context so its stages are recorded with ours.
+                futures.append(executor.submit(contextvars.copy_context().run, self.grade_threshold,
+                                               preprocessed, test, page_number, threshold_constant, image_name,
+                                               verbose_mode, debug_mode, scale, url, cancelled))
+            for index, future in enumerate(futures):
+                future.add_done_callback(functools.partial(attempt_done, index))
+            try:
+                for threshold_constant, future in zip(threshold_list, futures):
+                    yield threshold_constant, future.result()
+            finally:
+                # The caller stopped looking at attempts, so none of the running ones matter anymore.
+                cancel_after(-1)
 
     def grade(self, image_name, verbose_mode, debug_mode, scale, test, page_number, url = None):
         """
-        Grades a test image and outputs the result to stdout as a JSON object.
-        It goes through many different thresholds to make sure that we get the page
+        Grades a test image file and returns the result as a JSON object.
+        See grade_page.
 
         Args:
             image_name (str): Filepath to the test image to be graded.
@@ -478,9 +673,47 @@ class Grader:
             page_number (int): Page number of test
             url (str): The url for the image being graded. If not specified, we guess from image name (for test framework).
         """
-        # Initialize dictionary to be returned.
-        data = self.initialize_return_data()
+        return self.grade_image(image_name, verbose_mode, debug_mode, scale, test, page_number, url)
 
+    def grade_image(self, image, verbose_mode, debug_mode, scale, test, page_number, url = None):
+        """
+        Grades a test image and returns the result as a JSON object. See grade_page, which
+        returns the result itself for callers in this process.
+        """
+        return self.grade_page(image, verbose_mode, debug_mode, scale, test, page_number, url).to_json()
+
+    @instrumentation.records_timings
+    def grade_page(self, image, verbose_mode, debug_mode, scale, test, page_number, url = None):
+        """
+        Grades a test image.
+        It goes through many different thresholds to make sure that we get the page
+        If self.timings is set, the result has the time spent in each stage.
+
+        Args:
+            image (str, bytes or numpy.ndarray): Filepath to the test image to be graded, the contents
+                of the image file (so it never has to touch the disk), or the decoded image.
+            verbose_mode (bool): True to run program in verbose mode, False 
+                otherwise.
+            debug_mode (bool): True to run program in debug mode, False 
+                otherwise.
+            scale (str): Factor to scale image slices by.
+            test (str): Name of test
+            page_number (int): Page number of test
+            url (str): The url for the image being graded. If not specified, we guess from image name (for test framework).
+
+        Returns:
+            result (PageResult): The answers in every box, or what went wrong.
+        """
+        # Initialize result to be returned.
+        result = self.initialize_return_data()
+
+        # What we call the image in error messages.
+        if isinstance(image, str):
+            image_name = image
+        elif url is not None:
+            image_name = url
+        else:
+            image_name = '<in-memory image>'
         if url is None:
             url = image_name
         # Cast str to float for scale.
@@ -490,27 +723,27 @@ class Grader:
             try:
                 scale = float(scale)
             except ValueError:
-                data['status'] = 1
-                data['error'] = f'Scale {scale} must be castable to type float'
-                return self.format_error(data)
+                result.set_error(Status.ADMIN_ERROR, f'Scale {scale} must be castable to type float')
+                return self.finish_result(result)
 
         # Verify that scale is positive.
         if scale <= 0:
-            data['status'] = 1
-            data['error'] = f'Scale {scale} must be positive'
-            return self.format_error(data)
+            result.set_error(Status.ADMIN_ERROR, f'Scale {scale} must be positive')
+            return self.finish_result(result)
 
         # Load image. 
-        im = cv.imread(image_name)
+        im, original_size = self.load_image(image)
         if im is None:
-            data['status'] = 1
-            data['error'] = f'Image {image_name} not found'
-            return self.format_error(data)
-        im_w, im_h, _ = im.shape
+            if isinstance(image, str):
+                result.set_error(Status.ADMIN_ERROR, f'Image {image_name} not found')
+            else:
+                result.set_error(Status.ADMIN_ERROR, f'Image {image_name} could not be decoded')
+            return self.finish_result(result)
+        # Check the resolution of the image that was uploaded, not the one we grade.
+        im_w, im_h = original_size
         if im_w < 1000 or im_h < 1000:
-            data['status'] = 2
-            data['error'] = 'low_res_image'
-            return self.format_error(data)
+            result.set_error(Status.USER_ERROR, 'low_res_image')
+            return self.finish_result(result)
 
         # Find largest box within image.
         threshold_constant = 0
@@ -519,72 +752,48 @@ class Grader:
         elif test == 'sat':
             threshold_list = [25, 35, 50]
         else:
-            data['status'] = 2
-            data['error'] = f'unsupported_test_type'
-            return self.format_error(data)
+            result.set_error(Status.USER_ERROR, 'unsupported_test_type')
+            return self.finish_result(result)
+        # How much smaller the image we grade is than the uploaded one. The image slices are scaled
+        # up by the same amount so they come out the size they would be at full resolution.
+        working_scale = max(im.shape[:2]) / max(original_size)
+        scale = scale / working_scale
+
         page = None
-        for threshold_constant in threshold_list:
-            data = self.initialize_return_data()
-            try:
-                config_error = self.initialize_config(test, page_number)
-                if config_error is not None:
-                    data['status'] = 1
-                    data['error'] = config_error
-                    return self.format_error(data)
-                else:
-                    config = self.config
-                page = self.find_page(im, test, debug_mode, threshold_constant)
-            except Exception as e:
-                print(f"Unable to find page: {str(e)} at threshold {threshold_constant}.")
-                continue
-            if page is not None:
-                # Scale config values based on page size.
-                self.scale_config(config, page.shape[1], page.shape[0])
-                # Rotate page until upright.
-                page = self.upright_image(page, config)
-                if page is None:
-                    data['status'] = 3
-                    data['error'] = f'Could not upright page in {image_name}'
-                    return self.format_error(data)
-
-                # Grade each test box and add result to data.
-                for box_num, box_config in enumerate(config['boxes']):  
-                    #For debugging purposes: if box_num != 3: continue
-                    box_config['x_error'] = config['x_error']
-                    box_config['y_error'] = config['y_error']
-                    box_config['bubble_width'] = config['bubble_width']
-                    box_config['bubble_height'] = config['bubble_height']
-                    box_config['min_bubbles_per_box'] = config['min_bubbles_per_box']
-                    box_config['box_to_grade'] = config['box_to_grade']
-
-                    box = TestBox(page, box_config, verbose_mode, debug_mode, scale, test, threshold_constant, url) #make cleaner with new lines
-                    results = box.grade(page_number, box_num)
-                    if box.status == 0:
-                        data['boxes'].append({'name': box.name, 'results': results, 'status': box.status, 'error': box.error})
-                    else:
-                        break
-                successful_boxes = 0
-                for box in data['boxes']:
-                    if box['status'] == 0:
-                        successful_boxes+=1
-                if successful_boxes == len(config['boxes']):
-                    break
+        config = None
+        preprocessed = PreprocessedImage(im)
+        if self.threshold_workers > 1 and not debug_mode:
+            attempts = self.grade_thresholds_concurrently(preprocessed, test, page_number, threshold_list,
+                                                          image_name, verbose_mode, debug_mode, scale, url)
+        else:
+            attempts = self.grade_thresholds(preprocessed, test, page_number, threshold_list,
+                                             image_name, verbose_mode, debug_mode, scale, url)
+        # Go through the attempts in the order of threshold_list and stop at the first one that graded every box.
+        for threshold_constant, attempt in attempts:
+            result = attempt['result']
+            if attempt['finished']:
+                return self.finish_result(result)
+            if attempt['config'] is not None:
+                config = attempt['config']
+            if attempt['page_found']:
+                page = attempt['page']
+            if attempt['success']:
+                break
+        if working_scale != 1:
+            result.working_scale = working_scale
 
         if page is None:    
-            data['status'] = 2
-            data['error'] = 'page_not_found'
-            return self.format_error(data) 
+            result.set_error(Status.USER_ERROR, 'page_not_found')
+            return self.finish_result(result)
         
-        if len(config['boxes']) != len(data['boxes']):
-            data['status'] = 3
-            data['error'] = f'We found a page but were unable to find any boxes in {image_name} with threshold constant:{threshold_constant}'
-            return self.format_error(data)
-
-        for box in data['boxes']:
-            if box['status'] != 0:
-                data['status'] = 3
-                data['error'] = "One of the boxes in this page failed. For more details, look in the boxes['status'] and boxes['error']"
+        if len(config['boxes']) != len(result.boxes):
+            result.set_error(Status.BOX_ERROR, f'We found a page but were unable to find any boxes in {image_name} with threshold constant:{threshold_constant}')
+            return self.finish_result(result)
+
+        for box in result.boxes:
+            if box.status != Status.SUCCESS:
+                result.set_error(Status.BOX_ERROR, "One of the boxes in this page failed. For more details, look in the boxes['status'] and boxes['error']")
                 break
 
-        return self.format_error(data)
+        return self.finish_result(result)
 
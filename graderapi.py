@@ -1,39 +1,39 @@
+import contextlib
 import hashlib
 import json
 import os
 import shutil
 #email sending stuff
 import smtplib
-import ssl
-import jinja2
-import tempfile
 import traceback
 from collections import OrderedDict
 from datetime import date
-from email.message import EmailMessage
 
+import celery
 import flask
 import magic # for checking filetypes
-import pyodbc
-import yaml
-import requests
 from dotenv import load_dotenv
 load_dotenv()
 from worker import celeryapp
 import grader as g
+import database
+import telemetry
+import warmup
+from backpressure import IntakeMonitor
+from downloads import downloader
+from email_templates import email_templates
+from mailer import build_message, mailer
+from result_cache import result_cache
+from results import Status
 
 flaskapp = flask.Flask(__name__)
 flaskapp.config["DEBUG"] = True
+intake = IntakeMonitor(celeryapp)
 
 adminemail=os.getenv('ADMIN_EMAIL')
 DB_SERVER_NAME=os.getenv('DB_SERVER_NAME')
-DB_USER=os.getenv('DB_USER')
-DB_PASSWORD=os.getenv('DB_PASSWORD')
-DB_NAME=os.getenv('DB_NAME')
-SMTP_HOST=os.getenv('SMTP_HOST')
-SMTP_USERNAME=os.getenv('SMTP_USERNAME')
-SMTP_PASSWORD=os.getenv('SMTP_PASSWORD')
-SMTP_PORT=os.getenv('SMTP_PORT')
+EMAIL_MAX_RETRIES=int(os.getenv('EMAIL_MAX_RETRIES', 5))
+WORKER_WARMUP=os.getenv('WORKER_WARMUP', '1') == '1'
 
 #TODO .Heic
 #TODO If uploaded wrong page to wrong upload, then we can try it against other configs to see if they match.
@@ -50,154 +50,187 @@ def format_email_message(email_tag, email_variables):
             Formatted email subject, ready to send ('str')
             Formatted email body, ready to send ('str')
     """
-    email_messages_file = 'email_messages.yml'
-    with open(email_messages_file) as yaml_file:
-        raw_email_config = yaml_file.read().rstrip()
-    template = jinja2.Template(raw_email_config)
-    prepped_email_config = template.render(email_variables)
-    cooked_email_config = yaml.safe_load(prepped_email_config)
-    if not email_tag in cooked_email_config:
+    if not email_tag in email_templates:
+        message = f'email_tag {email_tag} does not exist in {email_templates.path}'
         email_tag = 'unhandled_image_error'
-        message = f'email_tag {email_tag} does not exist in {email_messages_file}'
         print(message)
         send_email(adminemail, 'Admin Error', messagelines=[message], send_email_flag=True)
-        
-    plated_email_config = [cooked_email_config[email_tag]['subject'],
-                           cooked_email_config[email_tag]['body']]
+
+    plated_email_config = list(email_templates.render(email_tag, email_variables))
     return plated_email_config
 
 #uploads parsed test data to database
 def upload_to_database(examinfo, page_answers):
-    conn = pyodbc.connect('Driver={ODBC Driver 17 for SQL Server};'
-                      f'Server={DB_SERVER_NAME};'
-                      f'Database={DB_NAME};'
-                      f'UID={DB_USER};'
-                      f'PWD={DB_PASSWORD};'
-                      'Trusted_Connection=no;')
-
-    cursor = conn.cursor()
-    cursor.execute("insert into Grader_Submissions "\
-                   "(First_Name, Last_Name, Email_Address, Test_Type, Test_ID, Submission_JSON) "  \
-                   "values (?,?,?,?,?,?)", examinfo['First Name'], examinfo['Last Name'], 
-                   examinfo['Email'], examinfo['Test'], examinfo['Test ID'], json.dumps(page_answers))
-    cursor.execute("SELECT @@IDENTITY")
-
-    submission_id = int(cursor.fetchone()[0])
-    print(f'created subission id {submission_id}')
-        
-    for section, answers in page_answers.items():
-        print(f'Inserting answers for section {section} right meow')
-        for qnum, answer in answers.items():
-            cursor.execute("insert into Grader_Submissions_Answers "\
-                        "(Submission_ID, Test_Section, Test_Question_Number, Test_Question_Answer)" \
-                        " values (?,?,?,?)", submission_id, section, qnum, answer)
-    conn.commit()
-
-def download_image(imgurl, imgfile):
-    #dowloads the imgurl and writes it into imgfile.
-    r = requests.get(imgurl, stream = True) 
-    if r.status_code == 200:
-        for block in r.iter_content(1024):
-            imgfile.write(block)
-        return True
+    #inserts the submission and its answers. DB_BACKEND picks the database (see database.py).
+    return database.get_database().upload_submission(examinfo, page_answers)
+
+    
+def grade_page(imgurl, imgbytes, test, page):
+    """
+    Grades one page of a submission.
+
+    Args:
+        imgurl (str): The url of the page's image.
+        imgbytes (bytes): The contents of the image, or None if it couldn't be downloaded.
+        test (str): The test type ('SAT', 'ACT'...).
+        page (int): The page number.
+
+    Returns:
+        page_result (dict): The page number, the name and answers of each box on the page, and the
+            user error or admin error we got grading it (None if there wasn't one).
+    """
+    page_result = {'page': page, 'boxes': [], 'usererror': None, 'adminerror': None}
+    if imgbytes is None:
+        page_result['adminerror'] = f'Unable to download {imgurl}'
+        return page_result
+    filetype = magic.from_buffer(imgbytes[:2048], mime=True)
+    if not (filetype == "image/png" or filetype == "image/jpeg"):
+        page_result['usererror'] = 'unsupported_image_format'
+        return page_result
+    print(f'Downloaded image succesfully. Grading page {page}')
+    grader = g.Grader()
+    # A page we've already graded (like a resubmitted photo) comes straight from the cache.
+    result = result_cache.grade(grader, imgbytes, test.lower(), page, imgurl)
+    if result.status == Status.SUCCESS:
+        for box in result.boxes:
+            print(box.bubbled)
+            # Question numbers are strings, like they are when a result comes back from the cache or another worker as JSON.
+            page_result['boxes'].append({'name': box.name, 'bubbled': {str(qnum): answer for qnum, answer in box.bubbled.items()}})
+    elif result.status == Status.USER_ERROR:
+        page_result['usererror'] = result.error
     else:
-        return False
-    imgfile.flush()
+        page_result['adminerror'] = result.error
+    return page_result
+
+def report_results(examinfo, send_email_flag, page_results):
+    """
+    Puts the answers from every page together (in page order), then uploads them to the database and
+    emails the student, or emails them (and us) about the errors. The first page with a user error 
+    stops everything after it, like it would if we graded the pages one at a time.
+
+    Args:
+        examinfo (dict): The submission (from handle_grader_message).
+        send_email_flag (bool): False to only print the emails instead of sending them.
+        page_results (list): What grade_page returned for each page, in page order.
+    """
+    usererrors = []
+    adminerrors = []
+    test = examinfo['Test']
+    email = examinfo['Email']
+    name = f'{examinfo["First Name"]} {examinfo["Last Name"]}'
+    page_answers = OrderedDict()
+    for page_result in page_results:
+        if page_result['usererror'] is not None:
+            usererrors.append(page_result['usererror'])
+            break
+        if page_result['adminerror'] is not None:
+            adminerrors.append(page_result['adminerror'])
+        for box in page_result['boxes']:
+            if not box['name'] in page_answers:
+                page_answers[box['name']] = OrderedDict()
+            page_answers[box['name']].update(box['bubbled'])
+
+    if len(adminerrors) == 0 and len(usererrors) == 0:
+        if not DB_SERVER_NAME == 'skipdb':
+            print('No admin errors or user errors, uploading to database meow.')  
+            upload_to_database(examinfo, page_answers)
+        subject, body = format_email_message('succesful_submission', {'test': test, 'name': name})
+        send_email(email, subject, [body], send_email_flag)
     
+    else:
+        print(f'We got some errors, not adding to database: adminerrors: {adminerrors}, usererrors: {usererrors}')
+        if len(usererrors) > 0:
+            try:
+                subject, body = format_email_message(usererrors[0], {'test': test, 'name': name})
+            except:
+                #this means we got a non-specific user error
+                subject, body = format_email_message('unhandled_image_error', {'test': test, 'name': name})
+            send_email(email, subject, [body], send_email_flag)
+
+        elif len(adminerrors) > 0:
+            subject, body = format_email_message('unhandled_image_error', {'test': test, 'name': name})
+            send_email(email, subject, [body], send_email_flag)
+            send_email(adminemail, 'Grader System Error', adminerrors, send_email_flag)
+
+        else:
+            send_email(adminemail, 'Crazy Town Error', [f'How did we get here? {[traceback.format_exc()]}'], send_email_flag)
+
+def grade_pages_in_parallel():
+    # Fanning out needs a result backend so report_results_task can collect the pages.
+    return bool(celeryapp.conf.result_backend)
+
+@celery.signals.worker_init.connect
+def warm_up_worker(**kwargs):
+    # Runs in the worker's parent process before it forks the pool, so every child starts hot.
+    if WORKER_WARMUP:
+        warmup.warm_up()
+
 @celeryapp.task
 def grade_test(examinfo, send_email_flag):
     try:
-        usererrors = []
-        adminerrors = []
         imgurls = examinfo['Image Urls']
         test = examinfo['Test']
         email = examinfo['Email']
-        name = f'{examinfo["First Name"]} {examinfo["Last Name"]}'
-        page_answers = OrderedDict()
         print(f'trying to grade from: {email} {test}')
-        for i, imgurl in enumerate(imgurls):
-            page = i + 1
-            with tempfile.TemporaryDirectory() as tmpdirname:
-                imgpath = f'{tmpdirname}/tmpimg'
-                with open(imgpath, 'wb') as imgfile:
-                    download_success = download_image(imgurl, imgfile)
-                if download_success:
-                    filetype = magic.from_file(imgpath, mime=True)
-                    if not (filetype == "image/png" or filetype == "image/jpeg"):
-                        usererrors.append('unsupported_image_format')
-                        break
-                    print(f'Wrote image into temporary file succesfully. Grading page {page}')
-                    grader = g.Grader()
-                    jsonData = grader.grade(imgpath, False, False, 1.0, test.lower(), page, imgurl)
-                    data = json.loads(jsonData)
-                    if data['status'] == 0:
-                        for box in data['boxes']:
-                            print(box['results']['bubbled'])
-                            if not box['name'] in page_answers:
-                                page_answers[box['name']] = OrderedDict()
-                            page_answers[box['name']].update(box['results']['bubbled'])
-                    elif data['status'] == 2:
-                        usererrors.append(data['error'])                      
-                        break
-                    else:
-                        adminerrors.append(data['error'])
-                else:
-                    adminerrors.append('Unable to download {imgurl}')
-                    
-        if len(adminerrors) == 0 and len(usererrors) == 0:
-            if not DB_SERVER_NAME == 'skipdb':
-                print('No admin errors or user errors, uploading to database meow.')  
-                upload_to_database(examinfo, page_answers)
-            subject, body = format_email_message('succesful_submission', {'test': test, 'name': name})
-            send_email(email, subject, [body], send_email_flag)
-        
-        else:
-            print(f'We got some errors, not adding to database: adminerrors: {adminerrors}, usererrors: {usererrors}')
-            if len(usererrors) > 0:
-                try:
-                    subject, body = format_email_message(usererrors[0], {'test': test, 'name': name})
-                except:
-                    #this means we got a non-specific user error
-                    subject, body = format_email_message('unhandled_image_error', {'test': test, 'name': name})
-                send_email(email, subject, [body], send_email_flag)
-
-            elif len(adminerrors) > 0:
-                subject, body = format_email_message('unhandled_image_error', {'test': test, 'name': name})
-                send_email(email, subject, [body], send_email_flag)
-                send_email(adminemail, 'Grader System Error', adminerrors, send_email_flag)
+        if grade_pages_in_parallel():
+            # Every page is graded by its own task, on whichever workers are free, and 
+            # report_results_task gets their results in page order once they are all done.
+            pages = [grade_page_task.s(imgurl, test, page) for page, imgurl in enumerate(imgurls, 1)]
+            celery.chord(pages)(report_results_task.s(examinfo, send_email_flag))
+            return
 
-            else:
-                send_email(adminemail, 'Crazy Town Error', [f'How did we get here? {[traceback.format_exc()]}'], send_email_flag)
+        page_results = []
+        # All the pages download at once, and each page is graded as soon as it (and the ones before it) arrive.
+        # The images stay in memory the whole way through.
+        with contextlib.closing(downloader.download_images(imgurls)) as downloads:
+            for page, (imgurl, imgbytes) in enumerate(downloads, 1):
+                page_result = grade_page(imgurl, imgbytes, test, page)
+                page_results.append(page_result)
+                if page_result['usererror'] is not None:
+                    break
+        print(f'intensity telemetry: {telemetry.get_diagnostics()}')
+        print(f'result cache: {result_cache.get_stats()}')
+        report_results(examinfo, send_email_flag, page_results)
+    except:
+        send_email(adminemail, 'Crazy Town Error', [f'How did we get here? {[traceback.format_exc()]}'], send_email_flag)
+
+@celeryapp.task
+def grade_page_task(imgurl, test, page):
+    try:
+        page_result = grade_page(imgurl, downloader.download_bytes(imgurl), test, page)
+    except:
+        # Still return a result, so report_results_task runs and tells us about it.
+        page_result = {'page': page, 'boxes': [], 'usererror': None, 'adminerror': f'Grading page {page} failed: {traceback.format_exc()}'}
+    print(f'intensity telemetry: {telemetry.get_diagnostics()}')
+    print(f'result cache: {result_cache.get_stats()}')
+    return page_result
+
+@celeryapp.task
+def report_results_task(page_results, examinfo, send_email_flag):
+    try:
+        report_results(examinfo, send_email_flag, sorted(page_results, key=lambda page_result: page_result['page']))
     except:
         send_email(adminemail, 'Crazy Town Error', [f'How did we get here? {[traceback.format_exc()]}'], send_email_flag)
 
 def send_email(email, subject='We had trouble grading your recent test.', messagelines=[], send_email_flag=False):
+    #queues the email for the email worker (see send_email_task), so grading never waits on the mail server.
     if not send_email_flag:
         print(f'Skipping email, but it would be {messagelines}')
         return
-    msg = EmailMessage()
-    msg['Subject'] = subject
-    msg['From'] = 'adminvpt@studypoint.com'
-    msg['To'] = email
-    msg['Bcc'] = 'k.langhorst@studypoint.com', 'max@langhorst.com', 'adminvpt@studypoint.com'
-    msg.set_content('\n'.join(messagelines))
-    context = ssl.create_default_context()
-    try:
-        s = smtplib.SMTP(host=SMTP_HOST, port=SMTP_PORT)
-        s.starttls(context=context) # Secure the connection
-        s.login(user=SMTP_USERNAME, password=SMTP_PASSWORD)
-        s.send_message(msg)
-    except Exception as e:
-        print(e)
-    finally:
-        s.quit()
+    send_email_task.delay(email, subject, list(messagelines))
+
+@celeryapp.task(autoretry_for=(smtplib.SMTPException, OSError), retry_backoff=True, retry_backoff_max=600,
+                max_retries=EMAIL_MAX_RETRIES)
+def send_email_task(email, subject, messagelines):
+    # Routed to the email queue (see worker.py). Reuses the worker's SMTP session and retries with backoff if sending fails.
+    mailer.send([build_message(email, subject, messagelines)])
 
 
 def examinfohash(examinfo):
     # makes a hash of everything except the imageurls in examinfo so we can identify student submissions
     dict = {k: v for k, v in examinfo.items() if not k == 'Image Urls'}
-    dict['Date Submitted'] = date.today
-    return hashlib.sha1(json.dumps(dict, sort_keys=True)).hexdigest()
+    dict['Date Submitted'] = date.today().isoformat()
+    return hashlib.sha1(json.dumps(dict, sort_keys=True).encode()).hexdigest()
 
 @flaskapp.route('/v1/grader', methods=['POST'])
 def handle_grader_message():
@@ -210,6 +243,11 @@ def handle_grader_message():
         print(flask.request.form['HandshakeKey'])
         flask.abort(418)
 
+    if not intake.should_accept():
+        # The workers are too far behind. Wufoo retries a 503, and Retry-After says when.
+        return flask.Response('The grader is busy, please try again later.', status=503,
+                              headers={'Retry-After': str(intake.retry_after)})
+
     test = flask.request.form['Field6']
     if test == 'ACT':
         imfields = [17]
@@ -243,8 +281,14 @@ def handle_grader_message():
         print(f"Not sending email")
         send_email = False
     grade_test.delay(examinfo, send_email)
+    intake.record_accepted()
     return flask.Response(status=202)
 
+@flaskapp.route('/v1/grader/status', methods=['GET'])
+def grader_status():
+    # The backlog and throughput, for monitoring. The counts are for this web process.
+    return flask.jsonify(intake.get_status())
+
 @flaskapp.route('/', methods=['GET'])
 def home():
     return "<h1>Grader API</h1><p.>This site is a API Portal for AutoGrader</p>"
@@ -0,0 +1,108 @@
+import contextvars
+import functools
+import threading
+import time
+import tracemalloc
+
+# The Timings being recorded for the image graded in this context, or None when we aren't recording.
+current_timings = contextvars.ContextVar('current_timings', default=None)
+
+
+class Timings:
+    """
+    Wall time, CPU time and call counts of the grading stages for one image, plus counters like how many
+    threshold constants we tried. Stages that run on other threads add to the same Timings.
+    CPU time is for the whole process, so a stage running next to other threads is charged for theirs too.
+    When tracemalloc is tracing, stages also record how much traced memory they left allocated.
+    """
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.counts = {}
+
+    def add_stage(self, name, elapsed, cpu, traced=None):
+        with self.lock:
+            stage = self.stages.setdefault(name, {'calls': 0, 'wall': 0.0, 'cpu': 0.0})
+            stage['calls'] += 1
+            stage['wall'] += elapsed
+            stage['cpu'] += cpu
+            if traced is not None:
+                stage['traced_mb'] = stage.get('traced_mb', 0.0) + traced / 2**20
+
+    def add_count(self, name, amount=1):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + amount
+
+    def to_dict(self):
+        """
+        Returns:
+            timings (dict): The total time since recording started, the calls, wall time and CPU time 
+                (in seconds) of each stage (and the traced memory it left allocated, in megabytes, if we 
+                were tracing), and the counters. Stage numbers include the stages called inside them.
+        """
+        with self.lock:
+            return {
+                'total': time.perf_counter() - self.start,
+                'stages': {name: dict(stage) for name, stage in self.stages.items()},
+                'counts': dict(self.counts)
+            }
+
+
+def records_timings(method):
+    """
+    Decorator for Grader.grade_page. When the grader's timings flag is set, it records Timings for
+    everything called inside the method (see get_timings). Otherwise it just calls the method.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if not self.timings or current_timings.get() is not None:
+            return method(self, *args, **kwargs)
+        token = current_timings.set(Timings())
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            current_timings.reset(token)
+    return wrapper
+
+
+def stage(name):
+    """
+    Decorator that adds the wall and CPU time of each call to the stage called name, when we are recording.
+    When we aren't, it costs one context variable lookup.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            timings = current_timings.get()
+            if timings is None:
+                return function(*args, **kwargs)
+            traced_start = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else None
+            start, cpu_start = time.perf_counter(), time.process_time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                elapsed, cpu = time.perf_counter() - start, time.process_time() - cpu_start
+                traced = None
+                if traced_start is not None and tracemalloc.is_tracing():
+                    traced = tracemalloc.get_traced_memory()[0] - traced_start
+                timings.add_stage(name, elapsed, cpu, traced)
+        return wrapper
+    return decorator
+
+
+def count(name, amount=1):
+    """
+    Adds amount to the counter called name, when we are recording.
+    """
+    timings = current_timings.get()
+    if timings is not None:
+        timings.add_count(name, amount)
+
+
+def get_timings():
+    """
+    Returns:
+        timings (Timings): The Timings being recorded in this context, or None.
+    """
+    return current_timings.get()
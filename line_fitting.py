@@ -0,0 +1,110 @@
+import numpy as np
+
+
+class LineFeatures:
+    """
+    Straight line fits of a list of contours (the candidate lines between the sections of an ACT
+    page), computed for all of them at once with numpy instead of point by point in Python.
+    For every contour we get the least squares slope and intercept, the points with the smallest
+    and largest x, the bounding box width, how far the points are from the line and the median y.
+    """
+    def __init__(self, contours):
+        """
+        Args:
+            contours (list): A list of contours in the form of np.array() (what cv.findContours returns).
+        """
+        self.contours = contours
+        self.size = len(contours)
+        self.counts = np.array([len(contour) for contour in contours], dtype=np.int64)
+        self.starts = np.zeros(self.size, dtype=np.int64)
+        if self.size == 0:
+            empty = np.zeros(0, dtype=np.float64)
+            self.points = np.zeros((0, 2), dtype=np.int64)
+            self.slope, self.intercept = empty, empty
+            self.width = self.height = np.zeros(0, dtype=np.int64)
+            self.deviations = empty
+            self.average_deviation, self.median_deviation, self.median_y = empty, empty, empty
+            self.first_index = self.last_index = np.zeros(0, dtype=np.int64)
+            return
+        np.cumsum(self.counts[:-1], out=self.starts[1:])
+        self.points = np.concatenate([contour.reshape(-1, 2) for contour in contours]).astype(np.int64)
+        xs = self.points[:, 0]
+        ys = self.points[:, 1]
+        # Same as cv.boundingRect for integer points.
+        self.width = np.maximum.reduceat(xs, self.starts) - np.minimum.reduceat(xs, self.starts) + 1
+        self.height = np.maximum.reduceat(ys, self.starts) - np.minimum.reduceat(ys, self.starts) + 1
+
+        # Least squares fit of y = slope*x + intercept (what np.polyfit(xs, ys, 1) does), with the
+        # sums taken around the means to keep them small.
+        mean_x = np.add.reduceat(xs, self.starts) / self.counts
+        mean_y = np.add.reduceat(ys, self.starts) / self.counts
+        dx = xs - np.repeat(mean_x, self.counts)
+        dy = ys - np.repeat(mean_y, self.counts)
+        sxx = np.add.reduceat(dx * dx, self.starts)
+        sxy = np.add.reduceat(dx * dy, self.starts)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.slope = sxy / sxx
+        self.intercept = mean_y - self.slope * mean_x
+        # A vertical contour has no least squares line, so let polyfit pick one like it always has.
+        for i in np.flatnonzero(sxx == 0):
+            contour_xs, contour_ys = self.get_points(i).T
+            self.slope[i], self.intercept[i] = np.polyfit(contour_xs, contour_ys, 1)
+
+        self.deviations = np.abs(ys - (np.repeat(self.slope, self.counts) * xs + np.repeat(self.intercept, self.counts)))
+        self.average_deviation = np.add.reduceat(self.deviations, self.starts) / self.counts
+        # The first point with the smallest x and the last point with the largest x, which is
+        # where a stable sort of the points by x puts them.
+        local_index = np.arange(len(xs)) - np.repeat(self.starts, self.counts)
+        is_min_x = xs == np.repeat(np.minimum.reduceat(xs, self.starts), self.counts)
+        is_max_x = xs == np.repeat(np.maximum.reduceat(xs, self.starts), self.counts)
+        self.first_index = np.minimum.reduceat(np.where(is_min_x, local_index, len(xs)), self.starts)
+        self.last_index = np.maximum.reduceat(np.where(is_max_x, local_index, -1), self.starts)
+        # numpy has no segmented median, so the medians are the one thing left in a Python loop.
+        self.median_deviation = np.empty(self.size)
+        self.median_y = np.empty(self.size)
+        for i, (start, end) in enumerate(zip(self.starts, self.starts + self.counts)):
+            self.median_deviation[i] = np.median(self.deviations[start:end])
+            self.median_y[i] = np.median(ys[start:end])
+
+    def get_points(self, i):
+        """
+        Returns the points of contour i as an (n, 2) ndarray.
+        """
+        return self.points[self.starts[i]:self.starts[i] + self.counts[i]]
+
+    def get_deviations(self, i):
+        """
+        Returns how far (in y) every point of contour i is from its line.
+        """
+        return self.deviations[self.starts[i]:self.starts[i] + self.counts[i]]
+
+    def get_properties(self, i):
+        """
+        Returns the properties of contour i: its first point (smallest x) and last point (largest x),
+        the slope and intercept of its line, its bounding box width and height, and the contour itself.
+        """
+        contour = self.contours[i]
+        return {
+                'first_point': contour[self.first_index[i]][0],
+                'last_point': contour[self.last_index[i]][0],
+                'slope': self.slope[i],
+                'intercept': self.intercept[i],
+                'width': int(self.width[i]),
+                'height': int(self.height[i]),
+                'contour': contour
+               }
+
+
+def get_first_and_last_points(contour, xy):
+    """
+    Gets the first and last points of a contour along x or y: the (first) point with the smallest
+    x (or y) and the (first) point with the largest.
+
+    Returns:
+        first_x, first_y, last_x, last_y: The coordinates of the two points.
+    """
+    points = contour.reshape(-1, 2)
+    axis = 0 if xy == 'x' else 1
+    first = points[np.argmin(points[:, axis])]
+    last = points[np.argmax(points[:, axis])]
+    return first[0], first[1], last[0], last[1]
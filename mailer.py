@@ -0,0 +1,118 @@
+import os
+import smtplib
+import ssl
+import threading
+import time
+from email.message import EmailMessage
+
+FROM_ADDRESS = 'adminvpt@studypoint.com'
+BCC_ADDRESSES = ('k.langhorst@studypoint.com', 'max@langhorst.com', 'adminvpt@studypoint.com')
+
+
+def build_message(email, subject, messagelines):
+    msg = EmailMessage()
+    msg['Subject'] = subject
+    msg['From'] = FROM_ADDRESS
+    msg['To'] = email
+    msg['Bcc'] = BCC_ADDRESSES
+    msg.set_content('\n'.join(messagelines))
+    return msg
+
+
+class Mailer:
+    """
+    Sends email over an SMTP session that stays open between messages, so we connect, STARTTLS
+    and log in once per worker thread instead of once per email. A session that has been idle
+    for a while is checked with NOOP before it is used, and one that errors is thrown away
+    (the caller retries, see graderapi.send_email_task).
+    """
+    def __init__(self, host=None, port=None, username=None, password=None, use_tls=None, idle_timeout=None):
+        """
+        Args:
+            host (str), port (int), username (str), password (str): The SMTP server. Default to the
+                SMTP_HOST, SMTP_PORT, SMTP_USERNAME and SMTP_PASSWORD environment variables. Without
+                a username we don't log in (like for a local debugging server).
+            use_tls (bool): Whether to STARTTLS. Defaults to the SMTP_TLS environment variable, or True.
+            idle_timeout (float): Seconds a session can sit unused before we check it's still open.
+                Defaults to the SMTP_IDLE_TIMEOUT environment variable, or 60.
+        """
+        self.host = host if host is not None else os.getenv('SMTP_HOST')
+        self.port = int(port if port is not None else os.getenv('SMTP_PORT') or 0)
+        self.username = username if username is not None else os.getenv('SMTP_USERNAME')
+        self.password = password if password is not None else os.getenv('SMTP_PASSWORD')
+        if use_tls is None:
+            use_tls = os.getenv('SMTP_TLS', '1') == '1'
+        self.use_tls = use_tls
+        if idle_timeout is None:
+            idle_timeout = float(os.getenv('SMTP_IDLE_TIMEOUT', 60))
+        self.idle_timeout = idle_timeout
+        self.local = threading.local()
+
+    def connect(self):
+        session = smtplib.SMTP(host=self.host, port=self.port)
+        try:
+            if self.use_tls:
+                session.starttls(context=ssl.create_default_context())
+            if self.username:
+                session.login(user=self.username, password=self.password)
+        except:
+            session.close()
+            raise
+        return session
+
+    def get_session(self):
+        """
+        Returns this thread's session, opening a new one if it is missing or has gone away.
+        """
+        session = getattr(self.local, 'session', None)
+        if session is not None and getattr(self.local, 'pid', None) != os.getpid():
+            # Inherited from the parent process across a fork, so the socket isn't ours to use.
+            session = None
+        if session is not None and time.monotonic() - self.local.last_used > self.idle_timeout:
+            try:
+                session.noop()
+            except (smtplib.SMTPException, OSError):
+                self.close_session(session)
+                session = None
+        if session is None:
+            session = self.connect()
+            self.local.session = session
+            self.local.pid = os.getpid()
+        self.local.last_used = time.monotonic()
+        return session
+
+    def close_session(self, session):
+        self.local.session = None
+        try:
+            session.quit()
+        except (smtplib.SMTPException, OSError):
+            session.close()
+
+    def send(self, messages):
+        """
+        Sends messages over one session.
+
+        Args:
+            messages (list): EmailMessages to send.
+
+        Raises:
+            smtplib.SMTPException, OSError: If sending fails. The session is closed, so the next
+                send starts a fresh one.
+
+        """
+        session = self.get_session()
+        try:
+            for msg in messages:
+                session.send_message(msg)
+        except (smtplib.SMTPException, OSError):
+            self.close_session(session)
+            raise
+        self.local.last_used = time.monotonic()
+
+    def close(self):
+        session = getattr(self.local, 'session', None)
+        if session is not None:
+            self.close_session(session)
+
+
+mailer = Mailer()
@@ -0,0 +1,205 @@
+import dataclasses
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+import config_registry
+from results import PageResult, Status
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_CACHE_DIR = os.path.join(ROOT_DIR, 'result_cache')
+# The modules whose code decides the result of grading a page.
+GRADING_MODULES = ['grader.py', 'test_box.py', 'utils.py', 'line_fitting.py', 'contour_features.py',
+                   'spatial_index.py', 'results.py']
+
+
+def get_code_fingerprint(modules=GRADING_MODULES):
+    """
+    Returns a hash of the source of the grading modules. It is part of every cache key, so results
+    graded by different code (like before a deploy) are never reused.
+    """
+    digest = hashlib.sha256()
+    for module in modules:
+        digest.update(module.encode())
+        with open(os.path.join(ROOT_DIR, module), 'rb') as f:
+            digest.update(hashlib.sha256(f.read()).digest())
+    return digest.hexdigest()
+
+
+CODE_FINGERPRINT = get_code_fingerprint()
+# Grading statuses worth remembering. Admin errors might not happen next time.
+CACHEABLE_STATUSES = (Status.SUCCESS, Status.USER_ERROR)
+
+
+class ResultCache:
+    """
+    Remembers the grading result of every page image, so a resubmitted photo (or a re-posted CSV export)
+    isn't graded again. Results are keyed by the SHA-256 of the image bytes plus the test, page, config
+    and grader settings and the grading code, and kept as one file per result in a directory that several
+    workers can share.
+    When the directory grows past its limit, the least recently used results are deleted.
+    """
+    def __init__(self, cache_dir=None, max_bytes=None):
+        """
+        Args:
+            cache_dir (str): Where to keep the results. Defaults to the RESULT_CACHE_DIR environment variable,
+                or result_cache next to this file.
+            max_bytes (int): How big the directory can get. Defaults to the RESULT_CACHE_MAX_MB environment
+                variable (in megabytes), or 100 MB. 0 turns the cache off.
+        """
+        if cache_dir is None:
+            cache_dir = os.getenv('RESULT_CACHE_DIR', DEFAULT_CACHE_DIR)
+        if max_bytes is None:
+            max_bytes = int(float(os.getenv('RESULT_CACHE_MAX_MB', 100)) * 2**20)
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.size = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def get_key(self, imgbytes, test, page_number, grader):
+        """
+        Returns:
+            key (str): The cache key for grading imgbytes as page_number of test with grader's settings.
+        """
+        settings = {
+            'code': CODE_FINGERPRINT,
+            'test': test,
+            'page': page_number,
+            'config': config_registry.registry.fingerprint(test, page_number),
+            'working_resolution': grader.working_resolution,
+            'max_image_pixels': grader.max_image_pixels
+        }
+        digest = hashlib.sha256(imgbytes)
+        digest.update(json.dumps(settings, sort_keys=True).encode())
+        return digest.hexdigest()
+
+    def get_path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.json')
+
+    def get(self, key):
+        """
+        Returns:
+            result (PageResult): The cached result for key, or None.
+        """
+        path = self.get_path(key)
+        try:
+            with open(path) as f:
+                jsonData = f.read()
+            # The mtime is when the result was last used.
+            os.utime(path)
+        except FileNotFoundError:
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return PageResult.from_json(jsonData)
+
+    def put(self, key, result):
+        """
+        Stores result under key if its status is worth remembering, then trims the cache if it got too big.
+        """
+        if result.status not in CACHEABLE_STATUSES:
+            return
+        # The stage timings belong to this grading, a hit isn't graded at all.
+        jsonData = dataclasses.replace(result, timings=None).to_json()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # Written to a temporary file and renamed, so other workers never read half a result.
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            f.write(jsonData)
+        os.replace(tmp_path, self.get_path(key))
+        with self.lock:
+            if self.size is None:
+                self.size = self.get_directory_size()
+            else:
+                self.size += len(jsonData)
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def get_entries(self):
+        entries = []
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if entry.name.endswith('.json'):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def get_directory_size(self):
+        return sum(size for _, size, _ in self.get_entries())
+
+    def evict(self):
+        # Other workers write to the same directory, so start from what's really there.
+        entries = sorted(self.get_entries())
+        self.size = sum(size for _, size, _ in entries)
+        # Trim to 90% so we aren't evicting on every put.
+        target = self.max_bytes * 0.9
+        for _, size, path in entries:
+            if self.size <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.size -= size
+            self.evictions += 1
+
+    def grade(self, grader, imgbytes, test, page_number, url=None):
+        """
+        Returns the cached result of grading imgbytes, or grades it with grader.grade_page and caches the result.
+
+        Args:
+            grader (Grader): The grader to use on a miss.
+            imgbytes (bytes): The contents of the image.
+            test (str): Name of test (sat, act, etc)
+            page_number (int): Page number of test
+            url (str): Where the image came from, for the logs.
+
+        Returns:
+            result (PageResult): The grading result.
+
+        """
+        if not self.enabled:
+            return grader.grade_page(imgbytes, False, False, 1.0, test, page_number, url)
+        key = self.get_key(imgbytes, test, page_number, grader)
+        result = self.get(key)
+        if result is not None:
+            print(f'Result cache hit for {url} ({test} page {page_number})')
+            return result
+        result = grader.grade_page(imgbytes, False, False, 1.0, test, page_number, url)
+        try:
+            self.put(key, result)
+        except OSError as e:
+            # A full or read-only disk shouldn't stop us from grading.
+            print(f'Unable to cache the result for {url}: {e}')
+        return result
+
+    def get_stats(self):
+        """
+        Returns:
+            stats (dict): How many hits, misses and evictions this process has had.
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else None,
+                'evictions': self.evictions
+            }
+
+
+result_cache = ResultCache()
@@ -0,0 +1,99 @@
+import dataclasses
+import enum
+import json
+
+
+class Status(enum.IntEnum):
+    """
+    How grading a page (or a box) went. The values are the 'status' numbers in the JSON results.
+    """
+    SUCCESS = 0
+    # Something is wrong on our end (a bad config, an image we couldn't load...).
+    ADMIN_ERROR = 1
+    # Something the student can fix (a low resolution image, a page we couldn't find...).
+    USER_ERROR = 2
+    # We found the page but couldn't grade every box on it.
+    BOX_ERROR = 3
+
+
+@dataclasses.dataclass
+class BoxResult:
+    """
+    The result of grading one box on a page.
+
+    Attributes:
+        name (str): The name of the box from the config.
+        results (dict): What TestBox.grade returned: the answers ('bubbled'), the questions we weren't
+            sure about ('unsure'), the image slices in verbose mode ('images'), and its status and error.
+        status (Status): How grading the box went.
+        error (str): What went wrong, or '' if nothing did.
+    """
+    name: str
+    results: dict
+    status: Status = Status.SUCCESS
+    error: str = ''
+
+    @property
+    def bubbled(self):
+        return self.results.get('bubbled')
+
+    def to_dict(self):
+        return {'name': self.name, 'results': self.results, 'status': int(self.status), 'error': self.error}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['name'], data['results'], Status(data['status']), data['error'])
+
+
+@dataclasses.dataclass
+class PageResult:
+    """
+    The result of grading a page, as returned by Grader.grade_page. It is only turned into JSON
+    (with to_json) when it leaves the process.
+
+    Attributes:
+        status (Status): How grading the page went.
+        error (str): What went wrong, or '' if nothing did. For user errors, this is the tag of the
+            email to send (see email_messages.yml).
+        boxes (list): The BoxResult of every box we graded, in the order of the config.
+        working_scale (float): How much the image was shrunk before grading, or None if it wasn't.
+        timings (dict): The time spent in each grading stage (see instrumentation.py), or None if
+            we weren't recording.
+    """
+    status: Status = Status.SUCCESS
+    error: str = ''
+    boxes: list = dataclasses.field(default_factory=list)
+    working_scale: float = None
+    timings: dict = None
+
+    def set_error(self, status, error):
+        self.status = status
+        self.error = error
+
+    def to_dict(self):
+        """
+        Returns:
+            data (dict): The result in the format Grader.grade has always returned.
+        """
+        data = {
+            'status': int(self.status),
+            'error': self.error,
+            'boxes': [box.to_dict() for box in self.boxes]
+        }
+        if self.working_scale is not None:
+            data['working_scale'] = self.working_scale
+        if self.timings is not None:
+            data['timings'] = self.timings
+        return data
+
+    def to_json(self):
+        return json.dumps(self.to_dict())
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(Status(data['status']), data['error'], [BoxResult.from_dict(box) for box in data['boxes']],
+                   data.get('working_scale'), data.get('timings'))
+
+    @classmethod
+    def from_json(cls, jsonData):
+        return cls.from_dict(json.loads(jsonData))
@@ -0,0 +1,65 @@
+import math
+
+
+class SpatialIndex:
+    """
+    A uniform grid used to find the bubbles near a point or rectangle without looping over all of them.
+    Items are stored in every cell their rectangle touches, so a query only has to look at the
+    cells its own rectangle touches. The cell size should be about the size of a bubble.
+    Rectangles that aren't finite (from nan or inf coordinates) are treated as covering everything,
+    which matches how the comparisons in the overlap checks treat them.
+    """
+    def __init__(self, cell_width, cell_height):
+        """
+        Args:
+            cell_width (float): The width of a grid cell.
+            cell_height (float): The height of a grid cell.
+        """
+        self.cell_width = cell_width
+        self.cell_height = cell_height
+        self.items = []
+        self.cells = {}
+        self.unbounded = []
+
+    def get_cell(self, x, y):
+        """
+        Returns the (column, row) of the cell containing the point x, y.
+        """
+        return math.floor(x / self.cell_width), math.floor(y / self.cell_height)
+
+    def get_cells(self, x_min, y_min, x_max, y_max):
+        """
+        Returns all the cells touched by the rectangle, including its edges.
+        """
+        col_min, row_min = self.get_cell(x_min, y_min)
+        col_max, row_max = self.get_cell(x_max, y_max)
+        return [(col, row) for col in range(col_min, col_max + 1) for row in range(row_min, row_max + 1)]
+
+    def insert(self, item, x_min, y_min, x_max, y_max):
+        """
+        Adds item to every cell touched by the rectangle.
+        """
+        order = len(self.items)
+        self.items.append(item)
+        if not is_finite(x_min, y_min, x_max, y_max):
+            self.unbounded.append(order)
+            return
+        for cell in self.get_cells(x_min, y_min, x_max, y_max):
+            self.cells.setdefault(cell, []).append(order)
+
+    def query(self, x_min, y_min, x_max, y_max):
+        """
+        Returns the items that share a cell with the rectangle, in the order they were inserted.
+        Every item whose rectangle touches this one is returned, but some that are only close
+        to it can be too, so callers still need to do their own exact check.
+        """
+        if not is_finite(x_min, y_min, x_max, y_max):
+            return list(self.items)
+        found = set(self.unbounded)
+        for cell in self.get_cells(x_min, y_min, x_max, y_max):
+            found.update(self.cells.get(cell, []))
+        return [self.items[order] for order in sorted(found)]
+
+
+def is_finite(*values):
+    return all(math.isfinite(value) for value in values)
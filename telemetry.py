@@ -0,0 +1,133 @@
+import atexit
+import logging
+import os
+import queue
+import threading
+from logging.handlers import MemoryHandler, QueueHandler, QueueListener, RotatingFileHandler
+
+from dotenv import load_dotenv
+
+CSV_LOGGER_NAME = 'csv'
+# How many rows the writer collects before writing them out.
+BATCH_SIZE = 512
+# How long (in seconds) a partial batch waits for more rows before it gets written anyway.
+FLUSH_INTERVAL = 2.0
+
+
+class BatchingQueueListener(QueueListener):
+    """
+    A QueueListener that writes out its MemoryHandler's partial batch whenever the queue
+    has been quiet for flush_interval seconds, so rows don't sit in memory between tests.
+    """
+    def __init__(self, row_queue, batch_handler, flush_interval):
+        super().__init__(row_queue, batch_handler)
+        self.batch_handler = batch_handler
+        self.flush_interval = flush_interval
+
+    def dequeue(self, block):
+        while True:
+            try:
+                return self.queue.get(block, timeout=self.flush_interval)
+            except queue.Empty:
+                if not block:
+                    raise
+                self.batch_handler.flush()
+
+
+class IntensitySink:
+    """
+    Process-wide sink for the bubble intensity rows (the csv logger).
+
+    Grading threads only put rows on an in-memory queue. A background thread takes them off,
+    collects them into batches and writes them to the rotating INTENSITY_CSV_LOG file, so
+    grading never waits on the disk. The logger gets exactly one handler per process no matter
+    how many TestBoxes are made. If INTENSITY_CSV_LOG isn't set the rows are thrown away.
+    """
+    def __init__(self, logger_name=CSV_LOGGER_NAME, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL):
+        self.logger_name = logger_name
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.pid = None
+        self.logger = None
+        self.queue = None
+        self.listener = None
+        self.batch_handler = None
+
+    def get_logger(self):
+        """
+        Returns the csv logger, setting it up the first time it is called in this process.
+        A forked child (like a celery worker) gets its own writer thread, since threads don't
+        survive a fork.
+
+        Returns:
+            logger (logging.Logger): The logger to write intensity rows to.
+        """
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    self.configure()
+        return self.logger
+
+    def configure(self):
+        load_dotenv()
+        logger = logging.getLogger(self.logger_name)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+        # Drop anything left over from before (handlers inherited from the parent process).
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+        self.queue, self.listener, self.batch_handler = None, None, None
+
+        logpath = os.getenv('INTENSITY_CSV_LOG')
+        if logpath:
+            max_log_size = int(os.getenv('MAX_LOG_SIZE', 0))
+            csvhandler = RotatingFileHandler(logpath, mode='a', maxBytes=max_log_size, backupCount=1, encoding=None, delay=True)
+            csvhandler.setFormatter(logging.Formatter('%(message)s'))
+            csvhandler.setLevel(logging.INFO)
+            self.batch_handler = MemoryHandler(self.batch_size, flushLevel=logging.CRITICAL, target=csvhandler)
+            self.queue = queue.SimpleQueue()
+            self.listener = BatchingQueueListener(self.queue, self.batch_handler, self.flush_interval)
+            self.listener.start()
+            logger.addHandler(QueueHandler(self.queue))
+        else:
+            logger.addHandler(logging.NullHandler())
+        self.logger = logger
+        self.pid = os.getpid()
+
+    def close(self):
+        """
+        Stops the writer thread after it writes out every queued row. The next get_logger starts a new one.
+        """
+        with self.lock:
+            if self.listener is not None and self.pid == os.getpid():
+                self.listener.stop()
+                csvhandler = self.batch_handler.target
+                self.batch_handler.close()
+                csvhandler.close()
+            self.pid = None
+
+    def get_diagnostics(self):
+        """
+        Returns:
+            diagnostics (dict): The number of handlers on the csv logger (should always be 1),
+                the number of rows waiting to be written, and whether the writer thread is running.
+        """
+        logger = logging.getLogger(self.logger_name)
+        return {
+            'handlers': len(logger.handlers),
+            'queued_rows': self.queue.qsize() if self.queue is not None else 0,
+            'writer_running': self.listener is not None and self.pid == os.getpid()
+        }
+
+
+sink = IntensitySink()
+atexit.register(sink.close)
+
+
+def get_csv_logger():
+    return sink.get_logger()
+
+
+def get_diagnostics():
+    return sink.get_diagnostics()
@@ -0,0 +1,83 @@
+import unittest
+import sys, os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', ''))
+from backpressure import IntakeMonitor
+
+class FakeMonitor(IntakeMonitor):
+    # Reads the backlog from attributes instead of a broker.
+    def __init__(self, **kwargs):
+        super().__init__(None, **kwargs)
+        self.depth = 0
+        self.running = None
+        self.reads = 0
+        self.worker_reads = 0
+
+    def read_queue_depth(self):
+        self.reads += 1
+        if self.depth is None:
+            raise ConnectionError('broker is down')
+        return self.depth
+
+    def read_workers(self):
+        self.worker_reads += 1
+        return self.running, None
+
+class FakeInspect:
+    # What inspect() answers for a grading worker and an email worker.
+    def active(self):
+        return {
+            'celery@grader': [{'name': 'graderapi.grade_page_task'}, {'name': 'graderapi.report_results_task'}],
+            'email@grader': [{'name': 'graderapi.send_email_task'}, {'name': 'graderapi.send_email_task'}]
+        }
+
+    def reserved(self):
+        return {'celery@grader': [{'name': 'graderapi.grade_test'}], 'email@grader': [{'name': 'graderapi.send_email_task'}]}
+
+    def stats(self):
+        return {
+            'celery@grader': {'total': {'graderapi.grade_test': 4, 'graderapi.report_results_task': 2}},
+            'email@grader': {'total': {'graderapi.send_email_task': 9}}
+        }
+
+class FakeApp:
+    class control:
+        @staticmethod
+        def inspect(timeout):
+            return FakeInspect()
+
+class IntakeMonitorTests(unittest.TestCase):
+
+    def test_high_water(self):
+        monitor = FakeMonitor(high_water=10, cache_seconds=0)
+        monitor.depth = 9
+        self.assertTrue(monitor.should_accept())
+        monitor.depth = 10
+        self.assertFalse(monitor.should_accept())
+        self.assertEqual(monitor.get_status()['rejected'], 1)
+        # If we can't tell how far behind we are, we don't turn anyone away.
+        monitor.depth = None
+        self.assertTrue(monitor.should_accept())
+
+    def test_backlog_is_cached(self):
+        monitor = FakeMonitor(high_water=10, cache_seconds=60)
+        for _ in range(5):
+            monitor.should_accept()
+        self.assertEqual(monitor.reads, 1)
+
+    def test_intake_does_not_ask_the_workers(self):
+        monitor = FakeMonitor(high_water=10, cache_seconds=0)
+        monitor.running = 3
+        for _ in range(5):
+            monitor.should_accept()
+        self.assertEqual(monitor.worker_reads, 0)
+        status = monitor.get_status()
+        self.assertEqual(monitor.worker_reads, 1)
+        self.assertEqual(status['in_flight'], 3)
+
+    def test_only_grading_tasks_are_in_flight(self):
+        monitor = IntakeMonitor(FakeApp(), high_water=10)
+        self.assertEqual(monitor.read_workers(), (2, 4))
+
+
+if __name__ == '__main__':
+    unittest.main()
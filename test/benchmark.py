@@ -0,0 +1,395 @@
+"""
+Benchmarks the grader on the bundled test images.
+
+Runs the tests in sat_test.py, act_test.py and mysteryset_test.py (so accuracy is measured against
+the answers they expect) and times every image they grade. The time spent in each pipeline stage comes
+from the grader's own timings (see instrumentation.py), wall and CPU time for each stage, plus the traced 
+memory each stage left allocated with --trace-memory. Stage numbers include the stages called inside
+them (get_bubbles includes bubble_cleanup, for example). Images graded from memory are reported as
+'<url> (in memory)'.
+
+Memory per image is peak_rss_increase_mb: how far the resident set grew above where it was when the
+image started, sampled in the background (Linux only). process_max_rss_mb is the peak of the whole
+benchmark process so far, which never goes down, so it is only reported for the run as a whole.
+
+    python test/benchmark.py run --repeat 3 --output before.json
+    python test/benchmark.py run --repeat 3 --output after.json
+    python test/benchmark.py compare before.json after.json
+"""
+import contextlib
+import datetime
+import functools
+import io
+import json
+import os
+import platform
+import resource
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+import unittest
+
+import click
+import cv2 as cv
+import numpy as np
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.join(TEST_DIR, '..')
+sys.path.append(ROOT_DIR)
+sys.path.append(TEST_DIR)
+import grader as g
+
+SUITES = ['sat_test', 'act_test', 'mysteryset_test']
+ENV_SETTINGS = ['GRADER_THRESHOLD_WORKERS', 'GRADER_WORKING_RESOLUTION', 'GRADER_MAX_IMAGE_PIXELS']
+
+
+class RssSampler:
+    """
+    Samples the resident set size of this process on a background thread while an image is graded,
+    to find how far above its starting point it peaked.
+    """
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.start_rss = None
+        self.peak_rss = None
+
+    def sample(self):
+        self.peak_rss = max(self.peak_rss, get_rss_bytes())
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            self.sample()
+
+    def __enter__(self):
+        self.start_rss = get_rss_bytes()
+        if self.start_rss is not None:
+            self.peak_rss = self.start_rss
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.thread is not None:
+            self.stop_event.set()
+            self.thread.join()
+            self.sample()
+
+    @property
+    def increase_mb(self):
+        if self.start_rss is None:
+            return None
+        return (self.peak_rss - self.start_rss) / 2**20
+
+
+class Recorder:
+    """
+    Collects the timings of every Grader.grade_page call (one per image) and of the stages inside it.
+    """
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.images = []
+
+    def grade(self, grade_page, grader, image, verbose_mode, debug_mode, scale, test, page_number, url=None):
+        image_name = image if isinstance(image, str) else f'{url} (in memory)'
+        record = {'image': f'{image_name}:{test}:{page_number}', 'stages': {}, 'counts': {}}
+        timings = grader.timings
+        grader.timings = True
+        if self.trace_memory:
+            # tracemalloc.reset_peak is Python 3.9+, restarting tracing also resets the peak.
+            tracemalloc.stop()
+            tracemalloc.start()
+        sampler = RssSampler()
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            with sampler:
+                result = grade_page(grader, image, verbose_mode, debug_mode, scale, test, page_number, url)
+        finally:
+            record['wall'] = time.perf_counter() - wall_start
+            record['cpu'] = time.process_time() - cpu_start
+            record['peak_rss_increase_mb'] = sampler.increase_mb
+            if self.trace_memory:
+                record['traced_peak_mb'] = tracemalloc.get_traced_memory()[1] / 2**20
+            self.images.append(record)
+            grader.timings = timings
+        record['status'] = int(result.status)
+        if result.timings is not None:
+            record['stages'] = result.timings['stages']
+            record['counts'] = result.timings['counts']
+        if not timings:
+            # The test sees the result it would have without the benchmark.
+            result.timings = None
+        return result
+
+
+def get_rss_bytes():
+    # The current resident set size, or None where there's no /proc.
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        return None
+
+
+def get_max_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS.
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / 2**20 if sys.platform == 'darwin' else max_rss / 2**10
+
+
+@contextlib.contextmanager
+def instrumented(recorder):
+    """
+    Wraps Grader.grade_page so every image the tests grade is timed by recorder, and puts it back afterwards.
+    """
+    grade_page = g.Grader.grade_page
+
+    @functools.wraps(grade_page)
+    def recorded_grade_page(*args, **kwargs):
+        return recorder.grade(grade_page, *args, **kwargs)
+
+    g.Grader.grade_page = recorded_grade_page
+    try:
+        yield
+    finally:
+        g.Grader.grade_page = grade_page
+
+
+def get_test_cases(suites, keyword):
+    loader = unittest.defaultTestLoader
+    cases = []
+    for suite in suites:
+        for case in iterate_tests(loader.loadTestsFromName(suite)):
+            if keyword is None or keyword in case.id():
+                cases.append(case)
+    return cases
+
+
+def iterate_tests(suite):
+    for test in suite:
+        if isinstance(test, unittest.TestSuite):
+            yield from iterate_tests(test)
+        else:
+            yield test
+
+
+def run_case(case, recorder):
+    """
+    Runs one test case and returns its outcome ('passed', 'failed' or 'error') and the images it graded.
+    """
+    result = unittest.TestResult()
+    first_image = len(recorder.images)
+    with contextlib.redirect_stdout(io.StringIO()):
+        case.run(result)
+    if result.errors:
+        outcome = 'error'
+    elif result.failures:
+        outcome = 'failed'
+    else:
+        outcome = 'passed'
+    return outcome, recorder.images[first_image:]
+
+
+def summarize_images(runs):
+    """
+    Combines the records of an image from every repeat into medians.
+    """
+    images = {}
+    for records in runs:
+        for record in records:
+            images.setdefault(record['image'], []).append(record)
+    summary = {}
+    for image, records in images.items():
+        stages = {}
+        counts = {}
+        for record in records:
+            for name, stage in record['stages'].items():
+                stages.setdefault(name, []).append(stage)
+            for name, value in record['counts'].items():
+                counts.setdefault(name, []).append(value)
+        summary[image] = {
+            'wall': statistics.median(r['wall'] for r in records),
+            'cpu': statistics.median(r['cpu'] for r in records),
+            'wall_runs': [r['wall'] for r in records],
+            'peak_rss_increase_mb': max_or_none(r['peak_rss_increase_mb'] for r in records),
+            'status': records[-1].get('status'),
+            'stages': {name: summarize_stage(stage_runs) for name, stage_runs in stages.items()},
+            'counts': {name: statistics.median(values) for name, values in counts.items()}
+        }
+        if 'traced_peak_mb' in records[0]:
+            summary[image]['traced_peak_mb'] = max(r['traced_peak_mb'] for r in records)
+    return summary
+
+
+def summarize_stage(stage_runs):
+    stage = {key: statistics.median(s[key] for s in stage_runs) for key in ('calls', 'wall', 'cpu')}
+    if all('traced_mb' in s for s in stage_runs):
+        stage['traced_mb'] = statistics.median(s['traced_mb'] for s in stage_runs)
+    return stage
+
+
+def max_or_none(values):
+    values = [value for value in values if value is not None]
+    return max(values) if values else None
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option('--repeat', type=int, default=1, help='how many times to grade every image')
+@click.option('--suite', 'suites', multiple=True, type=click.Choice(SUITES), help='test files to run (default all of them)')
+@click.option('-k', 'keyword', help='only run tests with this in their name')
+@click.option('--trace-memory', is_flag=True, help='also measure the peak python/numpy memory of each image with tracemalloc (slower)')
+@click.option('--output', type=click.Path(dir_okay=False), help='file to write the results to as JSON')
+def run(repeat, suites, keyword, trace_memory, output):
+    """
+    Grades the test images and reports timings and accuracy.
+    """
+    # The tests use paths relative to the repo.
+    os.chdir(ROOT_DIR)
+    cases = get_test_cases(suites or SUITES, keyword)
+    recorder = Recorder(trace_memory)
+    if trace_memory:
+        tracemalloc.start()
+    tests = {}
+    runs = []
+    with instrumented(recorder):
+        for i in range(repeat):
+            run_images = []
+            for case in cases:
+                outcome, images = run_case(case, recorder)
+                test = tests.setdefault(case.id(), {'outcomes': [], 'wall': []})
+                test['outcomes'].append(outcome)
+                test['wall'].append(sum(image['wall'] for image in images))
+                run_images.extend(images)
+                click.echo(f'[{i + 1}/{repeat}] {case.id()}: {outcome} ({test["wall"][-1]:.2f}s)', err=True)
+            runs.append(run_images)
+    for test in tests.values():
+        test['passed'] = all(outcome == 'passed' for outcome in test['outcomes'])
+
+    images = summarize_images(runs)
+    total_wall = sum(image['wall'] for image in images.values())
+    stage_totals = {}
+    stage_cpu_totals = {}
+    stage_traced_totals = {}
+    count_totals = {}
+    for image in images.values():
+        for name, stage in image['stages'].items():
+            stage_totals[name] = stage_totals.get(name, 0) + stage['wall']
+            stage_cpu_totals[name] = stage_cpu_totals.get(name, 0) + stage['cpu']
+            if 'traced_mb' in stage:
+                stage_traced_totals[name] = stage_traced_totals.get(name, 0) + stage['traced_mb']
+        for name, value in image['counts'].items():
+            count_totals[name] = count_totals.get(name, 0) + value
+    passed = sum(test['passed'] for test in tests.values())
+    results = {
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'repeat': repeat,
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'opencv': cv.__version__,
+            'cpu_count': os.cpu_count(),
+            'settings': {name: os.getenv(name) for name in ENV_SETTINGS}
+        },
+        'summary': {
+            'tests': len(tests),
+            'passed': passed,
+            'accuracy': passed / len(tests) if tests else None,
+            'images': len(images),
+            'total_wall': total_wall,
+            'images_per_second': len(images) / total_wall if total_wall else None,
+            'stages': stage_totals,
+            'stage_cpu': stage_cpu_totals,
+            'stage_traced_mb': stage_traced_totals,
+            'counts': count_totals,
+            'process_max_rss_mb': get_max_rss_mb()
+        },
+        'tests': tests,
+        'images': images
+    }
+    print_summary(results)
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+def print_summary(results):
+    summary = results['summary']
+    click.echo(f'{summary["passed"]}/{summary["tests"]} tests passed, {summary["images"]} images in {summary["total_wall"]:.1f}s '
+               f'(median of {results["repeat"]} runs)')
+    click.echo(f'  {"stage":40} {"wall":>9} {"cpu":>9}' + (f' {"traced":>10}' if summary['stage_traced_mb'] else ''))
+    for name, wall in sorted(summary['stages'].items(), key=lambda stage: -stage[1]):
+        line = f'  {name:40} {wall:8.2f}s {summary["stage_cpu"][name]:8.2f}s'
+        if name in summary['stage_traced_mb']:
+            line += f' {summary["stage_traced_mb"][name]:8.1f}MB'
+        click.echo(line)
+    for name, value in sorted(summary['counts'].items()):
+        click.echo(f'  {name:40} {value:8}')
+    peak_increases = [image['peak_rss_increase_mb'] for image in results['images'].values() if image['peak_rss_increase_mb'] is not None]
+    if peak_increases:
+        click.echo(f'largest RSS increase for one image: {max(peak_increases):.1f}MB, '
+                   f'process peak: {summary["process_max_rss_mb"]:.1f}MB')
+
+
+@cli.command()
+@click.argument('baseline', type=click.File())
+@click.argument('candidate', type=click.File())
+@click.option('--tolerance', type=float, default=0.1, help='how much slower (as a fraction) counts as a regression')
+def compare(baseline, candidate, tolerance):
+    """
+    Compares two benchmark results. Exits with 1 if the candidate is slower or less accurate.
+    """
+    old, new = json.load(baseline), json.load(candidate)
+    regressions = []
+
+    for test_id, test in old['tests'].items():
+        if test['passed'] and not new['tests'].get(test_id, {}).get('passed', False):
+            regressions.append(f'{test_id} no longer passes')
+    fixed = [test_id for test_id, test in new['tests'].items() if test['passed'] and not old['tests'].get(test_id, {}).get('passed', False)]
+
+    old_wall, new_wall = old['summary']['total_wall'], new['summary']['total_wall']
+    click.echo(f'total: {old_wall:.1f}s -> {new_wall:.1f}s ({change(old_wall, new_wall)})')
+    if new_wall > old_wall * (1 + tolerance):
+        regressions.append(f'total time went from {old_wall:.1f}s to {new_wall:.1f}s')
+    for name in sorted(set(old['summary']['stages']) | set(new['summary']['stages'])):
+        old_stage, new_stage = old['summary']['stages'].get(name, 0), new['summary']['stages'].get(name, 0)
+        click.echo(f'  {name:40} {old_stage:8.2f}s -> {new_stage:8.2f}s ({change(old_stage, new_stage)})')
+        # Results from before stages had CPU time (or traced memory) don't have these.
+        old_cpu, new_cpu = old['summary'].get('stage_cpu', {}).get(name), new['summary'].get('stage_cpu', {}).get(name)
+        if old_cpu is not None and new_cpu is not None:
+            click.echo(f'  {"":40} {old_cpu:8.2f}s -> {new_cpu:8.2f}s cpu ({change(old_cpu, new_cpu)})')
+        old_traced = old['summary'].get('stage_traced_mb', {}).get(name)
+        new_traced = new['summary'].get('stage_traced_mb', {}).get(name)
+        if old_traced is not None and new_traced is not None:
+            click.echo(f'  {"":40} {old_traced:8.1f}MB -> {new_traced:8.1f}MB traced')
+    for image, new_image in new['images'].items():
+        old_image = old['images'].get(image)
+        if old_image is not None and new_image['wall'] > old_image['wall'] * (1 + tolerance):
+            click.echo(f'  slower: {image} {old_image["wall"]:.2f}s -> {new_image["wall"]:.2f}s')
+        old_rss, new_rss = (old_image or {}).get('peak_rss_increase_mb'), new_image.get('peak_rss_increase_mb')
+        if old_rss is not None and new_rss is not None and new_rss > old_rss * (1 + tolerance) and new_rss - old_rss > 1:
+            click.echo(f'  more memory: {image} {old_rss:.1f}MB -> {new_rss:.1f}MB')
+
+    click.echo(f'accuracy: {old["summary"]["passed"]}/{old["summary"]["tests"]} -> {new["summary"]["passed"]}/{new["summary"]["tests"]}')
+    for test_id in fixed:
+        click.echo(f'  now passes: {test_id}')
+    for regression in regressions:
+        click.echo(f'REGRESSION: {regression}')
+    sys.exit(1 if regressions else 0)
+
+
+def change(old, new):
+    if not old:
+        return 'n/a'
+    return f'{(new - old) / old:+.0%}'
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,62 @@
+import unittest
+import json
+import os
+import shutil
+import sys
+import tempfile
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', ''))
+import config_registry
+
+class ConfigRegistryTests(unittest.TestCase):
+
+    def setUp(self):
+        self.config_dir = tempfile.mkdtemp()
+        shutil.copy(os.path.join(config_registry.CONFIG_DIR, 'sat_page1.json'), self.config_dir)
+        self.registry = config_registry.ConfigRegistry(self.config_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.config_dir)
+
+    def test_copies_are_independent(self):
+        config, error = self.registry.get('sat', 1)
+        self.assertIsNone(error)
+        config['boxes'][0]['x'] = 999
+        config, _ = self.registry.get('sat', 1)
+        self.assertEqual(config['boxes'][0]['x'], 0.0)
+
+    def test_scaled_copy(self):
+        config, _ = self.registry.get('sat', 1, 620, 795)
+        self.assertEqual(config['bubble_width'], 12.5)
+        self.assertEqual(config['boxes'][0]['groups'][0]['y_min'], 25.0)
+
+    def test_missing_config(self):
+        config, error = self.registry.get('sat', 9)
+        self.assertIsNone(config)
+        self.assertIn('not found', error)
+
+    def test_reload_on_change(self):
+        config, _ = self.registry.get('sat', 1)
+        self.assertEqual(config['bubble_width'], 25.0)
+
+        config_fname = self.registry.config_path('sat', 1)
+        with open(config_fname) as file:
+            raw_config = json.load(file)
+        raw_config['bubble_width'] = 30.0
+        with open(config_fname, 'w') as file:
+            json.dump(raw_config, file)
+        stat = os.stat(config_fname)
+        os.utime(config_fname, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        config, _ = self.registry.get('sat', 1)
+        self.assertEqual(config['bubble_width'], 30.0)
+
+        raw_config['bubble_width'] = 'wide'
+        with open(config_fname, 'w') as file:
+            json.dump(raw_config, file)
+        os.utime(config_fname, ns=(stat.st_atime_ns, stat.st_mtime_ns + 2*10**9))
+        config, error = self.registry.get('sat', 1)
+        self.assertIsNone(config)
+        self.assertIsNotNone(error)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import unittest
+import sys, os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', ''))
+import sqlite3
+import tempfile
+import database
+
+class SqliteDatabaseTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db = database.SqliteDatabase(os.path.join(self.tmpdir.name, 'grader.sqlite'))
+        self.examinfo = {
+            'First Name': 'Max',
+            'Last Name': 'Langhorst',
+            'Email': 'max@langhorst.com',
+            'Test': 'SAT',
+            'Test ID': 'Practice Test #1'
+        }
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_upload_submission(self):
+        page_answers = {'1': {'1': 'A', '2': 'B'}, '4': {'1': 12.4, '2': '-'}}
+        first = self.db.upload_submission(self.examinfo, page_answers)
+        second = self.db.upload_submission(self.examinfo, {'1': {'1': 'C'}})
+        self.assertNotEqual(first, second)
+        conn = self.db.get_connection()
+        rows = conn.execute('select Test_Section, Test_Question_Number, Test_Question_Answer from Grader_Submissions_Answers '\
+                            'where Submission_ID = ? order by rowid', (first,)).fetchall()
+        self.assertEqual(rows, [('1', '1', 'A'), ('1', '2', 'B'), ('4', '1', '12.4'), ('4', '2', '-')])
+
+    def test_connection_is_reused(self):
+        self.db.upload_submission(self.examinfo, {'1': {'1': 'A'}})
+        conn = self.db.get_connection()
+        self.db.release_connection(conn)
+        self.db.upload_submission(self.examinfo, {'1': {'1': 'B'}})
+        self.assertIs(self.db.get_connection(), conn)
+
+    def test_dropped_connection_is_replaced(self):
+        class DroppedConnection:
+            closed = False
+            def cursor(self):
+                raise sqlite3.OperationalError('Communication link failure')
+            def close(self):
+                self.closed = True
+        dropped = DroppedConnection()
+        self.db.release_connection(dropped)
+        submission_id = self.db.upload_submission(self.examinfo, {'1': {'1': 'A'}})
+        self.assertTrue(dropped.closed)
+        conn = self.db.get_connection()
+        self.assertIsNot(conn, dropped)
+        rows = conn.execute('select Test_Question_Answer from Grader_Submissions_Answers where Submission_ID = ?',
+                            (submission_id,)).fetchall()
+        self.assertEqual(rows, [('A',)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import unittest
+import sys, os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', ''))
+import functools
+import threading
+import time
+from http.server import HTTPServer, SimpleHTTPRequestHandler
+from downloads import Downloader
+
+IMAGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'images')
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+class DownloaderTests(unittest.TestCase):
+
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), functools.partial(QuietHandler, directory=IMAGE_DIR))
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_downloads_in_page_order(self):
+        names = ['sat_test1.jpg', 'sat_test2.jpg', 'missing.jpg', 'sat_test2a.png']
+        downloader = Downloader(workers=3, timeout=5, retries=0)
+        results = list(downloader.download_images([f'{self.url}/{name}' for name in names]))
+        self.assertEqual([imgurl for imgurl, _ in results], [f'{self.url}/{name}' for name in names])
+        for name, (_, imgbytes) in zip(names, results):
+            if name == 'missing.jpg':
+                self.assertIsNone(imgbytes)
+            else:
+                with open(os.path.join(IMAGE_DIR, name), 'rb') as original:
+                    self.assertEqual(imgbytes, original.read())
+
+    def test_stopping_early_cancels_pending_downloads(self):
+        downloader = Downloader(workers=1, timeout=5, retries=0)
+        started = []
+        release = threading.Event()
+        def download_bytes(imgurl):
+            started.append(imgurl)
+            if len(started) > 1:
+                release.wait(5)
+            return b'image'
+        downloader.download_bytes = download_bytes
+        imgurls = [f'{self.url}/page{page}.jpg' for page in range(1, 5)]
+        images = downloader.download_images(imgurls)
+        self.assertEqual(next(images), (imgurls[0], b'image'))
+        images.close()
+        release.set()
+        # Give a cancelled download the chance to (wrongly) start.
+        time.sleep(0.2)
+        self.assertEqual(started[0], imgurls[0])
+        self.assertNotIn(imgurls[2], started)
+        self.assertNotIn(imgurls[3], started)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+import unittest
+import sys, os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', ''))
+import tempfile
+from email_templates import EmailTemplates
+
+class EmailTemplatesTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'email_messages.yml')
+        self.write('Hello {{name}}')
+        self.templates = EmailTemplates(self.path)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write(self, greeting, mtime=None):
+        with open(self.path, 'w') as f:
+            f.write(f'welcome:\n  subject: Your {{{{test}}}} test\n  body: |\n    {greeting}\n\n    StudyPoint\n')
+        if mtime is not None:
+            os.utime(self.path, (mtime, mtime))
+
+    def test_render(self):
+        subject, body = self.templates.render('welcome', {'test': 'SAT', 'name': 'Max\nwelcome: {subject: hacked}'})
+        self.assertEqual(subject, 'Your SAT test')
+        self.assertEqual(body, 'Hello Max\nwelcome: {subject: hacked}\n\nStudyPoint\n')
+        self.assertNotIn('missing', self.templates)
+
+    def test_reloads_when_file_changes(self):
+        self.templates.render('welcome', {'test': 'SAT', 'name': 'Max'})
+        self.write('Hi {{name}}', mtime=os.stat(self.path).st_mtime + 10)
+        subject, body = self.templates.render('welcome', {'test': 'SAT', 'name': 'Max'})
+        self.assertEqual(body, 'Hi Max\n\nStudyPoint\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,26 @@
+import unittest
+import json
+import sys, os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', ''))
+import grader as g
+import instrumentation
+
+class TimingsTests(unittest.TestCase):
+
+    def test_no_timings_by_default(self):
+        data = json.loads(g.Grader(timings=False).grade('test/images/does_not_exist.jpg', False, False, 1.0, 'sat', 1))
+        self.assertNotIn('timings', data)
+        self.assertIsNone(instrumentation.get_timings())
+
+    def test_timings(self):
+        data = json.loads(g.Grader(timings=True).grade('test/images/does_not_exist.jpg', False, False, 1.0, 'sat', 1))
+        self.assertEqual(data['status'], 1)
+        self.assertEqual(data['timings']['stages']['load_image']['calls'], 1)
+        self.assertGreaterEqual(data['timings']['total'], data['timings']['stages']['load_image']['wall'])
+        self.assertGreaterEqual(data['timings']['stages']['load_image']['cpu'], 0)
+        self.assertNotIn('traced_mb', data['timings']['stages']['load_image'])
+        self.assertIsNone(instrumentation.get_timings())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+import unittest
+import sys, os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', ''))
+import numpy as np
+from line_fitting import LineFeatures, get_first_and_last_points
+import grader as g
+
+def make_contour(points):
+    return np.array(points, dtype=np.int32).reshape(-1, 1, 2)
+
+class LineFeaturesTests(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        xs = np.arange(0, 500, 5)
+        self.contours = [
+            make_contour(np.column_stack((xs, np.round(0.02 * xs + 40 + rng.normal(0, 2, len(xs)))))),
+            make_contour([[10, 5], [3, 7], [3, 9], [20, 8], [20, 4], [12, 6]]),
+            # Vertical, so there's no least squares line.
+            make_contour([[7, 1], [7, 5], [7, 9]])
+        ]
+        self.features = LineFeatures(self.contours)
+
+    def test_matches_polyfit(self):
+        for i, contour in enumerate(self.contours[:2]):
+            m, b = np.polyfit(contour[:, 0, 0], contour[:, 0, 1], 1)
+            self.assertAlmostEqual(self.features.slope[i], m)
+            self.assertAlmostEqual(self.features.intercept[i], b)
+            deviations = np.abs(contour[:, 0, 1] - (m * contour[:, 0, 0] + b))
+            self.assertAlmostEqual(self.features.average_deviation[i], np.average(deviations))
+        self.assertTrue(np.isfinite(self.features.slope[2]))
+
+    def test_points(self):
+        properties = self.features.get_properties(1)
+        # The first of the points with the smallest x, and the last of the ones with the largest.
+        self.assertEqual(list(properties['first_point']), [3, 7])
+        self.assertEqual(list(properties['last_point']), [20, 4])
+        self.assertEqual((properties['width'], properties['height']), (18, 6))
+        self.assertEqual(get_first_and_last_points(self.contours[1], 'x'), (3, 7, 20, 8))
+        self.assertEqual(get_first_and_last_points(self.contours[1], 'y'), (20, 4, 3, 9))
+        self.assertEqual(list(self.features.median_y), [np.median(contour[:, 0, 1]) for contour in self.contours])
+        for i, contour in enumerate(self.contours):
+            xs = contour[:, 0, 0]
+            self.assertEqual(self.features.first_index[i], np.argmin(xs))
+            self.assertEqual(self.features.last_index[i], len(xs) - 1 - np.argmax(xs[::-1]))
+
+
+def quadratic_merge_lines(contour_properties, imgray):
+    # merge_lines as it was before the sort and sweep, comparing every pair.
+    clean_contour_properties = []
+    page_height, page_width = imgray.shape
+    y_threshold = 0.007*page_height
+    x_threshold = 0.1*page_width
+    ignored = set()
+    for i, cp in enumerate(contour_properties):
+        if i in ignored:
+            continue
+        for j in range(i + 1, len(contour_properties)):
+            cp2 = contour_properties[j]
+            if np.abs(cp['slope'] - cp2['slope']) < 0.01 and \
+               np.abs(cp['first_point'][1] - cp2['first_point'][1]) < y_threshold and \
+               np.abs(cp['first_point'][0] - cp2['first_point'][0]) < x_threshold and \
+               np.abs(cp['last_point'][0] - cp2['last_point'][0]) < x_threshold:
+                ignored.add(j)
+                break
+        clean_contour_properties.append(cp)
+    return clean_contour_properties
+
+class MergeLinesTests(unittest.TestCase):
+
+    def test_matches_quadratic_merge(self):
+        rng = np.random.default_rng(1)
+        imgray = np.zeros((1000, 800), np.uint8)
+        grader = g.Grader()
+        for _ in range(200):
+            # Few distinct values so plenty of lines are close enough to merge.
+            contour_properties = [{
+                    'slope': rng.choice([0.0, 0.005, 0.02]),
+                    'first_point': np.array([rng.integers(0, 100), rng.integers(0, 40)], np.int32),
+                    'last_point': np.array([rng.integers(600, 800), rng.integers(0, 40)], np.int32)
+                } for _ in range(rng.integers(0, 25))]
+            expected = [id(cp) for cp in quadratic_merge_lines(contour_properties, imgray)]
+            self.assertEqual([id(cp) for cp in grader.merge_lines(contour_properties, imgray)], expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
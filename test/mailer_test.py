@@ -0,0 +1,67 @@
+import unittest
+import sys, os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', ''))
+import socketserver
+import threading
+import mailer
+
+class DebuggingSMTPHandler(socketserver.StreamRequestHandler):
+    # Just enough SMTP to accept messages without TLS or a login, like a local debugging server.
+    def handle(self):
+        self.server.connections += 1
+        self.reply('220 localhost')
+        data = None
+        for line in self.rfile:
+            line = line.decode().rstrip('\r\n')
+            if data is not None:
+                if line == '.':
+                    self.server.messages.append('\n'.join(data))
+                    data = None
+                    self.reply('250 OK')
+                else:
+                    data.append(line)
+                continue
+            command = line[:4].upper()
+            if command == 'DATA':
+                data = []
+                self.reply('354 go ahead')
+            elif command == 'QUIT':
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('250 OK')
+
+    def reply(self, line):
+        self.wfile.write(f'{line}\r\n'.encode())
+
+
+class MailerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), DebuggingSMTPHandler)
+        self.server.daemon_threads = True
+        self.server.connections = 0
+        self.server.messages = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.mailer = mailer.Mailer(host='127.0.0.1', port=self.server.server_address[1], username='', use_tls=False)
+
+    def tearDown(self):
+        self.mailer.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_session_is_reused(self):
+        for i in range(3):
+            self.mailer.send([mailer.build_message('student@example.com', f'Results {i}', ['line 1', 'line 2'])])
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(len(self.server.messages), 3)
+        self.assertIn('Subject: Results 2', self.server.messages[2])
+
+    def test_connect_failure_raises(self):
+        closed = mailer.Mailer(host='127.0.0.1', port=1, username='', use_tls=False)
+        with self.assertRaises(OSError):
+            closed.send([mailer.build_message('student@example.com', 'Results', ['line'])])
+
+
+if __name__ == '__main__':
+    unittest.main()
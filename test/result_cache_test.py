@@ -0,0 +1,92 @@
+import unittest
+import sys, os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', ''))
+import tempfile
+import result_cache
+from result_cache import ResultCache
+from results import BoxResult, PageResult, Status
+
+class CountingGrader:
+    # Stands in for Grader, so the tests don't spend their time grading.
+    working_resolution = None
+    max_image_pixels = None
+
+    def __init__(self, status=Status.SUCCESS):
+        self.status = status
+        self.calls = 0
+        self.stage_timings = None
+
+    def grade_page(self, image, verbose_mode, debug_mode, scale, test, page_number, url=None):
+        self.calls += 1
+        return PageResult(self.status, boxes=[BoxResult('1', {'bubbled': {'1': 'A'}, 'padding': 'x' * 1000})],
+                          timings=self.stage_timings)
+
+class ResultCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache = ResultCache(self.tmpdir.name, max_bytes=2**20)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_identical_images_are_graded_once(self):
+        grader = CountingGrader()
+        first = self.cache.grade(grader, b'image', 'sat', 1)
+        second = self.cache.grade(grader, b'image', 'sat', 1)
+        self.cache.grade(grader, b'image', 'sat', 2)
+        self.cache.grade(grader, b'other image', 'sat', 1)
+        self.assertEqual(first, second)
+        self.assertEqual(grader.calls, 3)
+        self.assertEqual(self.cache.get_stats()['hits'], 1)
+
+    def test_hits_have_no_timings(self):
+        grader = CountingGrader()
+        grader.stage_timings = {'stages': {'find_page': 1.5}, 'counts': {}}
+        first = self.cache.grade(grader, b'image', 'sat', 1)
+        second = self.cache.grade(grader, b'image', 'sat', 1)
+        self.assertEqual(first.timings, grader.stage_timings)
+        self.assertIsNone(second.timings)
+        self.assertEqual(second.boxes, first.boxes)
+
+    def test_admin_errors_are_not_cached(self):
+        grader = CountingGrader(status=Status.ADMIN_ERROR)
+        self.cache.grade(grader, b'image', 'sat', 1)
+        self.cache.grade(grader, b'image', 'sat', 1)
+        self.assertEqual(grader.calls, 2)
+
+    def test_least_recently_used_are_evicted(self):
+        self.cache.max_bytes = 5000
+        grader = CountingGrader()
+        for i in range(4):
+            self.cache.grade(grader, f'image {i}'.encode(), 'sat', 1)
+            key = self.cache.get_key(f'image {i}'.encode(), 'sat', 1, grader)
+            os.utime(self.cache.get_path(key), (i, i))
+        # Using image 0 makes image 1 the least recently used.
+        self.cache.grade(grader, b'image 0', 'sat', 1)
+        self.cache.grade(grader, b'image 4', 'sat', 1)
+        self.assertLessEqual(self.cache.get_directory_size(), 5000)
+        grader.calls = 0
+        self.cache.grade(grader, b'image 0', 'sat', 1)
+        self.cache.grade(grader, b'image 1', 'sat', 1)
+        self.assertEqual(grader.calls, 1)
+
+    def test_new_grading_code_misses(self):
+        grader = CountingGrader()
+        self.cache.grade(grader, b'image', 'sat', 1)
+        fingerprint = result_cache.CODE_FINGERPRINT
+        try:
+            result_cache.CODE_FINGERPRINT = result_cache.get_code_fingerprint(['grader.py'])
+            self.cache.grade(grader, b'image', 'sat', 1)
+        finally:
+            result_cache.CODE_FINGERPRINT = fingerprint
+        self.cache.grade(grader, b'image', 'sat', 1)
+        self.assertEqual(grader.calls, 2)
+
+    def test_default_directory_is_next_to_the_code(self):
+        root_dir = os.path.dirname(os.path.abspath(result_cache.__file__))
+        self.assertEqual(result_cache.DEFAULT_CACHE_DIR, os.path.join(root_dir, 'result_cache'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,24 @@
+import unittest
+import sys, os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', ''))
+import json
+from results import BoxResult, PageResult, Status
+
+class PageResultTests(unittest.TestCase):
+
+    def test_json_round_trip(self):
+        result = PageResult(boxes=[BoxResult('1', {'bubbled': {'1': 'A', '2': 12.4}, 'unsure': [], 'status': 0, 'error': ''})],
+                            working_scale=0.5)
+        data = json.loads(result.to_json())
+        self.assertEqual(list(data), ['status', 'error', 'boxes', 'working_scale'])
+        self.assertEqual(data['boxes'][0]['results']['bubbled'], {'1': 'A', '2': 12.4})
+        self.assertEqual(PageResult.from_json(result.to_json()), result)
+
+    def test_error(self):
+        result = PageResult()
+        result.set_error(Status.USER_ERROR, 'page_not_found')
+        self.assertEqual(result.to_dict(), {'status': 2, 'error': 'page_not_found', 'boxes': []})
+
+
+if __name__ == '__main__':
+    unittest.main()
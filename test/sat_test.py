@@ -1,9 +1,23 @@
 import unittest
 import json
 import sys, os
+import tempfile
 sys.path.append(os.path.join(os.path.dirname(__file__), '..', ''))
+import cv2 as cv
+import numpy as np
 import grader as g
 
+def with_exif_orientation(im, orientation):
+    """
+    Encodes im as a JPEG with an EXIF orientation tag, like a phone photo taken on its side.
+    """
+    _, encoded = cv.imencode('.jpg', im)
+    # A big endian TIFF header with one IFD entry: orientation (0x0112), SHORT, count 1.
+    tiff = (b'MM\x00\x2a\x00\x00\x00\x08\x00\x01' + b'\x01\x12\x00\x03\x00\x00\x00\x01' +
+            orientation.to_bytes(2, 'big') + b'\x00\x00' + b'\x00\x00\x00\x00')
+    app1 = b'Exif\x00\x00' + tiff
+    return b'\xff\xd8\xff\xe1' + (len(app1) + 2).to_bytes(2, 'big') + app1 + encoded.tobytes()[2:]
+
 class ExampleImageTests(unittest.TestCase):
     #turn both to true to see images.
     verbose_mode = False
@@ -34,6 +48,45 @@ class ExampleImageTests(unittest.TestCase):
                                                                     'B B D D B C C D C A D C A'.split(' ') +
                                                                     'D A C C D D C B B A B D D'.split(' ') )
 
+    def test_page1_in_memory(self):
+        grader = g.Grader()
+        with open('test/images/sat_test1.jpg', 'rb') as f:
+            imgbytes = f.read()
+        expected = json.loads(grader.grade('test/images/sat_test1.jpg', self.debug_mode, self.verbose_mode, 1.0, 'sat', 1))
+        from_bytes = json.loads(grader.grade_image(imgbytes, self.debug_mode, self.verbose_mode, 1.0, 'sat', 1, 'test/images/sat_test1.jpg'))
+        self.assertEqual(from_bytes, expected)
+
+    def test_page1_exif_rotated(self):
+        # Stored on its side, orientation 6 turns it back upright.
+        im = cv.rotate(cv.imread('test/images/sat_test1.jpg'), cv.ROTATE_90_COUNTERCLOCKWISE)
+        imgbytes = with_exif_orientation(im, 6)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            image_name = os.path.join(tmpdir, 'sat_test1_rotated.jpg')
+            with open(image_name, 'wb') as f:
+                f.write(imgbytes)
+            grader = g.Grader()
+            from_file, _ = grader.load_image(image_name)
+            from_bytes, _ = grader.load_image(imgbytes)
+            self.assertTrue(np.array_equal(from_bytes, from_file))
+            self.assertGreater(from_bytes.shape[0], from_bytes.shape[1])
+            expected = json.loads(grader.grade(image_name, self.debug_mode, self.verbose_mode, 1.0, 'sat', 1))
+            data = json.loads(grader.grade_image(imgbytes, self.debug_mode, self.verbose_mode, 1.0, 'sat', 1, image_name))
+        self.assertEqual(data, expected)
+        self.assertEqual(data['status'], 0)
+
+    def test_exif_orientations_match_imread(self):
+        im = cv.imread('test/images/sat_test1.jpg')[:300, :200]
+        grader = g.Grader()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for orientation in range(1, 9):
+                imgbytes = with_exif_orientation(im, orientation)
+                image_name = os.path.join(tmpdir, f'orientation{orientation}.jpg')
+                with open(image_name, 'wb') as f:
+                    f.write(imgbytes)
+                from_file, _ = grader.load_image(image_name)
+                from_bytes, _ = grader.load_image(imgbytes)
+                self.assertTrue(np.array_equal(from_bytes, from_file), f'orientation {orientation}')
+
     def test_page2(self):
         grader = g.Grader()
         jsonData = grader.grade('test/images/sat_test2.jpg', self.debug_mode, self.verbose_mode, 1.0, 'sat', 2)
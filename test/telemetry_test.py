@@ -0,0 +1,41 @@
+import unittest
+import sys, os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', ''))
+import logging
+import tempfile
+import telemetry
+
+class IntensitySinkTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.logpath = os.path.join(self.tmpdir.name, 'intensities.csv')
+        self.old_logpath = os.environ.get('INTENSITY_CSV_LOG')
+        os.environ['INTENSITY_CSV_LOG'] = self.logpath
+        self.sink = telemetry.IntensitySink(logger_name='csv_test')
+
+    def tearDown(self):
+        self.sink.close()
+        if self.old_logpath is None:
+            del os.environ['INTENSITY_CSV_LOG']
+        else:
+            os.environ['INTENSITY_CSV_LOG'] = self.old_logpath
+        self.tmpdir.cleanup()
+
+    def test_one_handler_per_process(self):
+        loggers = [self.sink.get_logger() for _ in range(10)]
+        self.assertTrue(all(logger is loggers[0] for logger in loggers))
+        self.assertEqual(len(logging.getLogger('csv_test').handlers), 1)
+        self.assertEqual(self.sink.get_diagnostics()['handlers'], 1)
+
+    def test_rows_are_written_once(self):
+        for i in range(1000):
+            self.sink.get_logger().info(f'url,sat,1,{i}')
+        self.sink.close()
+        with open(self.logpath) as f:
+            rows = f.read().splitlines()
+        self.assertEqual(rows, [f'url,sat,1,{i}' for i in range(1000)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+import unittest
+import sys, os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', ''))
+import cv2 as cv
+import numpy as np
+import utils
+
+class ThresholdFamilyTests(unittest.TestCase):
+
+    def setUp(self):
+        im = cv.imread('test/images/sat_test1.jpg')
+        self.imgray = cv.cvtColor(im, cv.COLOR_BGR2GRAY)
+        # A box sized crop keeps the reference get_threshold calls fast.
+        self.box = cv.bitwise_not(self.imgray[1200:1900, 300:1500])
+
+    def test_box_constants_match_get_threshold(self):
+        family = utils.ThresholdFamily(self.box)
+        out = np.empty_like(self.box)
+        for constant in np.linspace(0, 30, 75):
+            expected = utils.get_threshold(self.box, constant)
+            self.assertTrue(np.array_equal(family.threshold(constant), expected), f'constant {constant}')
+            self.assertIs(family.threshold(constant, out), out)
+            self.assertTrue(np.array_equal(out, expected), f'constant {constant} with out')
+
+    def test_page_constants_match_get_threshold(self):
+        page = cv.resize(self.imgray, None, fx=0.5, fy=0.5)
+        family = utils.ThresholdFamily(page)
+        for constant in [15, 25, 35, 50, 75]:
+            self.assertTrue(np.array_equal(family.threshold(constant), utils.get_threshold(page, constant)), f'constant {constant}')
+
+class CoarseToFineSearchTests(unittest.TestCase):
+
+    def search(self, counts, target, **kwargs):
+        probed = []
+        def evaluate(index):
+            probed.append(index)
+            return counts[index], f'result {index}'
+        found = utils.coarse_to_fine_search(list(range(len(counts))), evaluate, target, **kwargs)
+        return found, probed
+
+    def test_few_candidates_is_linear_scan(self):
+        counts = [3, 5, 4, 5, 2]
+        (candidate, count, result), probed = self.search(counts, 5, num_coarse=8)
+        self.assertEqual((candidate, count, result), (1, 5, 'result 1'))
+        self.assertEqual(probed, [0, 1])
+
+    def test_no_match_returns_closest(self):
+        counts = [10 - abs(i - 40) // 4 for i in range(75)]
+        (candidate, count, _), probed = self.search(counts, 20)
+        self.assertEqual(count, 10)
+        self.assertEqual(counts[candidate], max(counts[i] for i in probed))
+        self.assertEqual(len(set(probed)), len(probed))
+        self.assertLessEqual(len(probed), 16)
+
+    def test_hit_on_boundaries(self):
+        counts = [1] * 74 + [7]
+        (candidate, count, _), probed = self.search(counts, 7)
+        self.assertEqual((candidate, count), (74, 7))
+        self.assertIn(74, probed)
+
+        counts = [7] + [1] * 74
+        (candidate, _, _), probed = self.search(counts, 7)
+        self.assertEqual(candidate, 0)
+        self.assertEqual(probed, [0])
+
+    def test_refines_to_narrow_peak(self):
+        counts = [abs(i - 37) for i in range(75)]
+        (candidate, count, _), _ = self.search([-c for c in counts], 0)
+        self.assertEqual((candidate, count), (37, 0))
+
+    def test_max_probes(self):
+        counts = [abs(i - 60) for i in range(75)]
+        for max_probes in [1, 4, 8, 12, 16]:
+            _, probed = self.search(counts, -1, max_probes=max_probes)
+            self.assertLessEqual(len(probed), max_probes)
+            self.assertEqual(probed[0], 0)
+        _, probed = self.search(counts, -1, max_probes=4)
+        self.assertEqual(len(probed), 4)
+
+        # The hit is past the last probe we are allowed.
+        counts = [1] * 74 + [7]
+        (candidate, count, _), probed = self.search(counts, 7, max_probes=4)
+        self.assertEqual((candidate, count), (0, 1))
+        self.assertEqual(len(probed), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
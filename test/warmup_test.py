@@ -0,0 +1,15 @@
+import unittest
+import sys, os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', ''))
+import warmup
+
+class WarmupTests(unittest.TestCase):
+
+    def test_warm_up(self):
+        timings = warmup.warm_up()
+        self.assertEqual(list(timings), ['configs', 'email_templates', 'telemetry', 'synthetic_page', 'total'])
+        self.assertGreaterEqual(timings['total'], timings['synthetic_page'])
+
+
+if __name__ == '__main__':
+    unittest.main()
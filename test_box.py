@@ -6,11 +6,12 @@ import numpy as np
 from collections import OrderedDict
 import functools
 import utils
+from contour_features import ContourFeatures
+from spatial_index import SpatialIndex
 import operator
-from dotenv import load_dotenv
-import os 
 import logging
-from logging.handlers import RotatingFileHandler
+import telemetry
+import instrumentation
 
 class Error(Exception):
     pass
@@ -19,8 +20,65 @@ class BoxNotFoundError(Error):
     def __init__(self, message):
         self.message = message
 
+class BoxLocator:
+    """
+    Finds the answer boxes on a page. Which contours are boxes only depends on the page, the 
+    threshold constant and page-level config values, so one locator is shared by every TestBox 
+    on a page and the page threshold, contour search and is_box checks only happen once.
+    """
+    def __init__(self, page, threshold_constant):
+        """
+        Args:
+            page (numpy.ndarray): An ndarray representing the test image.
+            threshold_constant (float): The threshold constant used to threshold the page.
+        """
+        self.page = page
+        self.threshold_constant = threshold_constant
+        self.thresh_page = None
+        self.inverted_page = None
+        self.potential_boxes = None
+
+    def get_potential_boxes(self, test_box):
+        """
+        Finds the answer boxes the first time it is called and returns them sorted by y position.
+
+        Args:
+            test_box (TestBox): The test box asking. Its is_box check is used to find the boxes.
+
+        Returns:
+            list: The approximated contours of the answer boxes on the page.
+
+        """
+        if self.potential_boxes is None:
+            # Blur and threshold the page, then find boxes within the page.
+            self.thresh_page = utils.get_threshold(self.page, self.threshold_constant)
+            self.inverted_page = cv.bitwise_not(self.page)
+            contours, _ = cv.findContours(self.thresh_page, cv.RETR_TREE, cv.CHAIN_APPROX_SIMPLE)
+            potential_boxes = []
+            # Iterate through contours until the correct box is found.
+            for contour in contours:
+                if test_box.is_box(contour, self.thresh_page):
+                    if not test_box.similar_box_found(contour, potential_boxes):
+                        peri = cv.arcLength(contour, True)
+                        approx = cv.approxPolyDP(contour, 0.02 * peri, True)
+                        potential_boxes.append(approx)
+            #sorting the potential boxes by y position
+            self.potential_boxes = sorted(potential_boxes, key=lambda b:cv.boundingRect(b)[1])
+        return self.potential_boxes
+
+    def get_box_images(self, box_num):
+        """
+        Returns the transformed threshold and inverted grayscale images of a box.
+        """
+        box = self.potential_boxes[box_num]
+        return utils.get_transform(box, self.thresh_page), utils.get_transform(box, self.inverted_page)
+
+
 class TestBox:
-    def __init__(self, page, config, verbose_mode, debug_mode, scale, test, threshold_constant, url):
+    # The most box threshold constants we try before giving up on finding every bubble.
+    max_threshold_probes = 16
+
+    def __init__(self, page, config, verbose_mode, debug_mode, scale, test, threshold_constant, url, box_locator=None):
         """
         Constructor for a new test box.
 
@@ -34,6 +92,8 @@ class TestBox:
                 otherwise.
             scale (float): Factor to scale image slices by.
             url (str): url to image (used for logging)
+            box_locator (BoxLocator): Finds the boxes on the page. Pass the same one to every 
+                TestBox on a page so the boxes are only found once.
         Returns:
             TestBox: A newly created test box.
 
@@ -47,6 +107,9 @@ class TestBox:
         self.test = test
         self.threshold_constant = threshold_constant
         self.url = url
+        if box_locator is None:
+            box_locator = BoxLocator(page, threshold_constant)
+        self.box_locator = box_locator
         # Configuration values.
         self.name = config['name']
         self.type = config['type']
@@ -77,22 +140,12 @@ class TestBox:
         self.setup_loggers()
 
     def setup_loggers(self):
-        load_dotenv()
-
         #Console logs
         self.logger = logging.getLogger()        
         self.logger.setLevel(logging.INFO)
         
-        #CSV logs
-        logpath = os.getenv('INTENSITY_CSV_LOG')
-        max_log_size = int(os.getenv('MAX_LOG_SIZE'))
-        csvhandler = RotatingFileHandler(logpath, mode='a', maxBytes=max_log_size, backupCount=1, encoding=None, delay=0)
-        csvhandler.setFormatter(logging.Formatter('%(message)s'))
-        csvhandler.setLevel(logging.INFO)
-        self.csvlogger = logging.getLogger('csv')
-        self.csvlogger.setLevel(logging.INFO)
-        self.csvlogger.addHandler(csvhandler)
-        self.csvlogger.propagate = False
+        #CSV logs, shared by every TestBox in the process (see telemetry.py).
+        self.csvlogger = telemetry.get_csv_logger()
 
         
 
@@ -106,35 +159,33 @@ class TestBox:
         self.status = 1
         self.error = ''
 
-    def get_bubble_group(self, bubble):
+    def get_bubble_groups(self, features, indices):
         """
-        Finds and returns the group number that a bubble belongs to.
+        Finds the group each of the contours at indices belongs to, from the center of its fitted
+        ellipse (with margins for error). Their ellipses need to be fit.
 
         Args:
-            bubble (numpy.ndarray): An ndarray representing a bubble contour.
+            features (ContourFeatures): The features of the contours.
+            indices (numpy.ndarray): Which contours to find the groups of.
 
         Returns:
-            int: The bubble's group number or -1 if the bubble does not belong
-                to a group.
+            numpy.ndarray: The group number of each contour, or -1 if it does not belong to a group.
 
         """
-        #x, y, _w, _h = cv.boundingRect(bubble)
-        ellipse_bubble = cv.fitEllipse(bubble)
         #Add offsets to get coordinates in relation to the whole test image 
         #instead of in relation to the test box.
-        x = ellipse_bubble[0][0]
-        y = ellipse_bubble[0][1]
-        x += self.x
-        y += self.y
-
-        for (i, group) in enumerate(self.groups):
-            if (x >= group['x_min'] - self.x_error and
-                x <= group['x_max'] + self.x_error and
-                y >= group['y_min'] - self.y_error and
-                y <= group['y_max'] + self.y_error):
-                return i
-
-        return None
+        x = features.ellipse_x[indices, np.newaxis] + self.x
+        y = features.ellipse_y[indices, np.newaxis] + self.y
+        x_min = np.array([group['x_min'] for group in self.groups])
+        x_max = np.array([group['x_max'] for group in self.groups])
+        y_min = np.array([group['y_min'] for group in self.groups])
+        y_max = np.array([group['y_max'] for group in self.groups])
+        in_group = ((x >= x_min - self.x_error) &
+                    (x <= x_max + self.x_error) &
+                    (y >= y_min - self.y_error) &
+                    (y <= y_max + self.y_error))
+        # argmax gives the first group the bubble is in.
+        return np.where(in_group.any(axis=1), in_group.argmax(axis=1), -1)
     
     def erase_lines(self, box):
         """
@@ -183,32 +234,26 @@ class TestBox:
             cv.waitKey()
         return box
 
-    def is_bubble(self, contour, box):
+    def get_bubble_mask(self, features):
         """
-        Checks if a contour is of sufficient width and height, is somewhat
-        circular, and is within the correct coordinates, with margins for error,
-        to be counted as a bubble.
+        Checks which contours in features are of sufficient width and height, are somewhat
+        circular, and are within the correct coordinates, with margins for error, to be counted
+        as bubbles.
 
         Args:
-            contour (numpy.ndarray): An ndarray representing the contour being 
-                checked.
+            features (ContourFeatures): The features of the contours being checked.
 
         Returns:
-            bool: True if contour is counted as a bubble, False otherwise.
+            numpy.ndarray: A boolean ndarray that is True for the contours that are counted as bubbles.
 
         """
-        (x, y, w, h) = cv.boundingRect(contour)
+        w = features.w
+        h = features.h
         frac_of_row_used_by_bubbles = 0.6
         min_width = self.page.shape[1] / 50 * frac_of_row_used_by_bubbles #no test will have more than 50 bubbles in a row
         max_width = self.page.shape[1] / 20 * frac_of_row_used_by_bubbles #no test will have less than 20 bubbles in a row
-        if w < min_width or w > max_width:
-            return False
-        if len(contour) < 5:
-            return False
-        aspect_ratio = w / float(h)
+        aspect_ratio = w / h
         expected_aspect_ratio = self.bubble_width/self.bubble_height
-        if aspect_ratio > 2 or aspect_ratio < 0.5:
-            return False
         min_aspect_ratio = expected_aspect_ratio * 0.8
         max_aspect_ratio = expected_aspect_ratio * 1.3
 
@@ -219,36 +264,29 @@ class TestBox:
             min_rotation = 86
             max_rotation = 94    
 
-        ellipse = cv.fitEllipse(contour)
-        #ex, ey = ellipse[0]
-        eh, ew = ellipse[1]
-
-        rotation = ellipse[2]
-        ellipse_aspect_ratio = ew / float(eh)
-        max_aspect_ratio_dif = 0.2
-        aspect_ratio_dif = np.abs(aspect_ratio-ellipse_aspect_ratio)
-
-        # Add offsets to get coordinates in relation to the whole test image 
-        # instead of in relation to the test box.
-        x += self.x
-        y += self.y
-
         # Ignore contour if not of sufficient width or height, or not circular.
-        if (w < self.bubble_width * 0.8 or 
-            h < self.bubble_height * 0.8 or
-            w > self.bubble_width * 1.2 or 
-            h > self.bubble_height * 1.2 or
-            aspect_ratio < min_aspect_ratio or
-            aspect_ratio > max_aspect_ratio or 
-            aspect_ratio_dif > max_aspect_ratio_dif or 
-            rotation < min_rotation or
-            rotation > max_rotation):
-            # if self.debug_mode:
-            #     if aspect_ratio > min_aspect_ratio and aspect_ratio < max_aspect_ratio and w > 15:
-            #         print(f"not considered a bubble because width is {w:.2f} not between, {(self.bubble_width * 0.8):.2f}, {(self.bubble_width * 2.0):.2f}, or height is {h:.2f} not between, {(self.bubble_height * 0.8):.2f}, {(self.bubble_height * 2.0):.2f}, or aspect ratio is {aspect_ratio:.2f} not between {min_aspect_ratio}, {max_aspect_ratio}")
-            return False
-
-        return True
+        # These only need the bounding box, so we check them before fitting any ellipses.
+        mask = ((w >= min_width) & (w <= max_width) &
+                (features.counts >= 5) &
+                (aspect_ratio <= 2) & (aspect_ratio >= 0.5) &
+                (w >= self.bubble_width * 0.8) &
+                (h >= self.bubble_height * 0.8) &
+                (w <= self.bubble_width * 1.2) &
+                (h <= self.bubble_height * 1.2) &
+                (aspect_ratio >= min_aspect_ratio) &
+                (aspect_ratio <= max_aspect_ratio))
+
+        features.fit_ellipses(mask)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ellipse_aspect_ratio = features.ellipse_h / features.ellipse_w
+        max_aspect_ratio_dif = 0.2
+        aspect_ratio_dif = np.abs(aspect_ratio - ellipse_aspect_ratio)
+        rotation = features.ellipse_angle
+        # nan (no ellipse) compares False, so those contours stay out.
+        mask &= ((aspect_ratio_dif <= max_aspect_ratio_dif) &
+                 (rotation >= min_rotation) & 
+                 (rotation <= max_rotation))
+        return mask
 
     def contours_overlap(self, contour1, contour2):
         if contour1 is None:
@@ -339,16 +377,60 @@ class TestBox:
                     group.append([x, y])
         return locations
 
-    def get_overlapping_bubbles(self, bubbles, location):
+    def index_bubbles(self, bubbles):
         """
-        Loops through all the bubbles and returns any that overlap with location.
+        Puts the bounding box of every bubble in a SpatialIndex so get_overlapping_bubbles
+        only has to check the bubbles near a location.
+
+        Args:
+            bubbles (list): A list of lists, where each list is a group of bubble contours.
+
+        Returns:
+            bubble_grid (SpatialIndex): An index of the [group, bubble] indices of the bubbles.
         """
-        bubble_indices = []        
+        bubble_grid = SpatialIndex(self.bubble_width, self.bubble_height)
         for i, group in enumerate(bubbles):
             for j, bubble in enumerate(group):
-                if self.contours_overlap(bubble, location):
-                    bubble_index = [i, j]
-                    bubble_indices.append(bubble_index)
+                x, y, w, h = cv.boundingRect(bubble)
+                bubble_grid.insert([i, j], x, y, x + w, y + h)
+        return bubble_grid
+
+    def index_ellipses(self, bubbles):
+        """
+        Puts the ellipse of every bubble in a SpatialIndex, stored under the rectangle from get_ellipse_extremes.
+
+        Args:
+            bubbles (list): A list of lists, where each list is a group of bubble contours.
+
+        Returns:
+            ellipse_index (SpatialIndex): An index of the ellipses (what cv.fitEllipse returns) of the bubbles.
+        """
+        ellipse_index = SpatialIndex(self.bubble_width, self.bubble_height)
+        for group in bubbles:
+            for bubble in group:
+                if bubble is None:
+                    continue
+                ellipse = cv.fitEllipse(bubble)
+                ellipse_index.insert(ellipse, *self.get_ellipse_extremes(ellipse))
+        return ellipse_index
+
+    def get_overlapping_bubbles(self, bubbles, location, bubble_grid=None):
+        """
+        Returns the indices of the bubbles that overlap with location.
+        If bubble_grid (from index_bubbles) is given, only the bubbles near location are checked,
+        otherwise it loops through all of them.
+        """
+        if bubble_grid is None:
+            candidates = [[i, j] for i, group in enumerate(bubbles) for j in range(len(group))]
+        else:
+            # The same rectangle contours_overlap uses for a location.
+            w, h = self.bubble_width*0.4, self.bubble_height*0.4
+            x, y = location[0]-w, location[1]-h
+            candidates = bubble_grid.query(x, y, x + 2*w, y + 2*h)
+        bubble_indices = []
+        for i, j in candidates:
+            if self.contours_overlap(bubbles[i][j], location):
+                bubble_indices.append([i, j])
         return bubble_indices
 
     def all_contours_overlap(self, contour_list):
@@ -384,16 +466,21 @@ class TestBox:
         """
         Goes through the x and y positions of everygrid point and checks if the circles drawn 
         from them overlap. If they do, it returns False and if they don't it returns True.
+        Each point is only checked against the points already seen in the cells around it.
         """
+        max_x_dif, max_y_dif = self.bubble_width*0.8, self.bubble_height*0.8
         for group in grid:
+            point_index = SpatialIndex(max_x_dif, max_y_dif)
             for x1, y1 in group:
-                for x2, y2 in group:
+                for x2, y2 in point_index.query(x1 - max_x_dif, y1 - max_y_dif, x1 + max_x_dif, y1 + max_y_dif):
                     if x1 == x2 and y1 == y2:
                         continue
-                    if np.abs(x1 - x2) < self.bubble_width*0.8 and np.abs(y1 - y2) < self.bubble_height*0.8:
+                    if np.abs(x1 - x2) < max_x_dif and np.abs(y1 - y2) < max_y_dif:
                         return False
+                point_index.insert((x1, y1), x1, y1, x1, y1)
         return True
 
+    @instrumentation.stage('bubble_cleanup')
     def bubble_cleanup(self, bubbles, box_extremes, group_extremes, box):
         """
         Creates a "grid" of where the bubbles should be located based on the coordinates 
@@ -422,6 +509,10 @@ class TestBox:
         for _ in range(len(self.groups)):
             clean_bubbles.append([])
         model_bubble = self.get_model_bubble(bubbles)
+        bubble_grid = self.index_bubbles(bubbles)
+        # The ellipses of the clean bubbles, so a rescued bubble only gets compared to the ones around it.
+        # Only built once a bubble needs rescuing, since most boxes don't need any.
+        ellipse_index = None
         for group_num, group in enumerate(expected_bubble_locations):
             for bubble_num, location in enumerate(group):
                 if self.orientation == 'top-to-bottom':
@@ -433,18 +524,18 @@ class TestBox:
                     break
 
                 bubble_to_append = None
-                overlapping_indices = self.get_overlapping_bubbles(bubbles, location)
+                overlapping_indices = self.get_overlapping_bubbles(bubbles, location, bubble_grid)
                 overlapping_bubbles = [bubbles[oi[0]][oi[1]] for oi in overlapping_indices]
                 if len(overlapping_bubbles) == 0: #and len(clean_bubbles[group_num]) < self.num_questions:
                     bubble_to_append = self.rescue_expected_bubbles(model_bubble, location, clean_bubbles[group_num] + bubbles[group_num])
                     #if the bubble we think is correct overlapps with one that already exists
                     # everything is just wrong and we need to give up and try another threshold.
-                    for group in clean_bubbles:
-                        for bubble in group:
-                            if bubble is None:
-                                continue
-                            if self.ellipses_overlap(cv.fitEllipse(bubble_to_append), cv.fitEllipse(bubble)):
-                                return clean_bubbles
+                    if ellipse_index is None:
+                        ellipse_index = self.index_ellipses(clean_bubbles)
+                    rescued_ellipse = cv.fitEllipse(bubble_to_append)
+                    for ellipse in ellipse_index.query(*self.get_ellipse_extremes(rescued_ellipse)):
+                        if self.ellipses_overlap(rescued_ellipse, ellipse):
+                            return clean_bubbles
                 elif len(overlapping_bubbles) == 1:
                     bubble_to_append = overlapping_bubbles[0]
                     group_index, bubble_index = overlapping_indices[0]
@@ -459,9 +550,13 @@ class TestBox:
 
                 if bubble_to_append is not None: 
                     clean_bubbles[group_num].append(bubble_to_append)
+                    if ellipse_index is not None:
+                        ellipse = cv.fitEllipse(bubble_to_append)
+                        ellipse_index.insert(ellipse, *self.get_ellipse_extremes(ellipse))
 
         return clean_bubbles
 
+    @instrumentation.stage('get_bubbles')
     def get_bubbles(self, box):
         """
         Finds and return bubbles within the test box.
@@ -482,7 +577,6 @@ class TestBox:
 
         # Init empty list for each group of bubbles.
         allbubbles = []
-        nonbubbles = []
         group_extremes = []
         bubbles = []
         for _ in range(len(self.groups)):
@@ -490,27 +584,25 @@ class TestBox:
             group_extremes.append([[], []])
     
         box_extremes = [[], []]
-        # Check if contour is bubble; if it is, add to its appropriate group.
-        for contour in contours:
-            if self.is_bubble(contour, box):
-                allbubbles.append(contour)            
-                group_num = self.get_bubble_group(contour)
-                # if group_num == 1:
-                #     cv.drawContours(colorbox, [contour], -1, (255,0,140), 3)
-                #     cv.imshow('', colorbox)
-                #     cv.waitKey() 
-                if group_num is not None: 
-                    bubbles[group_num].append(contour)
-                    contour_y = np.mean([p[0][1] for p in contour])
-                    contour_x = np.mean([p[0][0] for p in contour])
-                    box_extremes[0].append(contour_x)
-                    box_extremes[1].append(contour_y)
-                    group_extremes[group_num][0].append(contour_x)
-                    group_extremes[group_num][1].append(contour_y)
-                else:
-                    print(f'no group found for bubble: Contour dimensions:{cv.fitEllipse(contour)} self.groups:{self.groups}')
+        # Check which contours are bubbles all at once, then add each bubble to its appropriate group.
+        features = ContourFeatures(contours)
+        bubble_mask = self.get_bubble_mask(features)
+        bubble_indices = np.flatnonzero(bubble_mask)
+        group_nums = self.get_bubble_groups(features, bubble_indices)
+        for i, group_num in zip(bubble_indices, group_nums):
+            contour = contours[i]
+            allbubbles.append(contour)            
+            if group_num >= 0: 
+                bubbles[group_num].append(contour)
+                contour_x = features.center_x[i]
+                contour_y = features.center_y[i]
+                box_extremes[0].append(contour_x)
+                box_extremes[1].append(contour_y)
+                group_extremes[group_num][0].append(contour_x)
+                group_extremes[group_num][1].append(contour_y)
             else:
-                nonbubbles.append(contour)
+                print(f'no group found for bubble: Contour dimensions:{features.get_ellipse(i)} self.groups:{self.groups}')
+        nonbubbles = [contours[i] for i in np.flatnonzero(~bubble_mask)]
         clean_bubbles = self.bubble_cleanup(bubbles, box_extremes, group_extremes, box)
         if self.debug_mode:
             # for contour in sorted(contours, key = lambda a: cv.boundingRect(a)[1]):
@@ -560,17 +652,14 @@ class TestBox:
 
     def box_contains_bubbles(self, box, threshold):
         (_x, _y, w, _h) = cv.boundingRect(box)
-        bubbles = []
         # Some boxes are too small and can't be 4-point-transformed so they aren't gonna be the one we want anyway.
         
         if w < 100:
             return False
         threshold = utils.get_transform(box, threshold)
         contours, _ = cv.findContours(threshold, cv.RETR_TREE, cv.CHAIN_APPROX_SIMPLE)
-
-        for contour in contours:
-            if self.is_bubble(contour, threshold):
-                bubbles.append(contour)
+        bubble_mask = self.get_bubble_mask(ContourFeatures(contours))
+        bubbles = [contours[i] for i in np.flatnonzero(bubble_mask)]
         # if self.debug_mode:
         #     colorim = cv.cvtColor(threshold, cv.COLOR_GRAY2BGR)
         #     cv.drawContours(colorim, bubbles, -1, (255,0,0), 3)
@@ -611,6 +700,14 @@ class TestBox:
             if self.contours_overlap(box, contour):
                 return True
 
+    def get_ellipse_extremes(self, ellipse):
+        """
+        Returns the rectangle (x_min, y_min, x_max, y_max) ellipses_overlap uses for an ellipse.
+        Two ellipses can only overlap if these rectangles do.
+        """
+        (x, y), (major, minor), _angle = ellipse
+        return x - minor/2, y - major/2, x + minor/2, y + major/2
+
     def ellipses_overlap(self, ellipse1, ellipse2):
         # **IMPORTANT** This function is not perfect. It uses the center point 
         # of an ellipse to create a rectangle and checks it against that other 
@@ -640,6 +737,7 @@ class TestBox:
                not (y1 > y2 + h2 + h1 - height_tolerance or y2 > y1 + h1 + h2 - height_tolerance) 
 
 
+    @instrumentation.stage('get_box')
     def get_box(self, box_num):
         """
         Finds and returns the contour for this test answer box.
@@ -649,20 +747,7 @@ class TestBox:
                 the test image.
 
         """
-        # Blur and threshold the page, then find boxes within the page.
-        thresh_page = utils.get_threshold(self.page, self.threshold_constant)
-        inverted_page = cv.bitwise_not(self.page)
-        contours, _ = cv.findContours(thresh_page, cv.RETR_TREE, cv.CHAIN_APPROX_SIMPLE)
-        potential_boxes = []
-        # Iterate through contours until the correct box is found.
-        for contour in contours:
-            if self.is_box(contour, thresh_page):
-                if not self.similar_box_found(contour, potential_boxes):
-                    peri = cv.arcLength(contour, True)
-                    approx = cv.approxPolyDP(contour, 0.02 * peri, True)
-                    potential_boxes.append(approx)
-        #sorting the potential boxes by y position
-        potential_boxes = sorted(potential_boxes, key=lambda b:cv.boundingRect(b)[1])
+        potential_boxes = self.box_locator.get_potential_boxes(self)
             
         if len(potential_boxes) == 0:
             raise BoxNotFoundError('No boxes found')
@@ -670,12 +755,11 @@ class TestBox:
             raise BoxNotFoundError('Not enough boxes found on the page')
         else:
             if self.debug_mode:
-                colorbox = cv.cvtColor(thresh_page, cv.COLOR_GRAY2BGR)
+                colorbox = cv.cvtColor(self.box_locator.thresh_page, cv.COLOR_GRAY2BGR)
                 cv.drawContours(colorbox, potential_boxes[box_num], -1, (255,0,255), 6)
                 cv.imshow('', colorbox)
                 cv.waitKey()                        
-            return utils.get_transform(potential_boxes[box_num], thresh_page), \
-                   utils.get_transform(potential_boxes[box_num], inverted_page)
+            return self.box_locator.get_box_images(box_num)
         
     def init_questions(self):
         """
@@ -884,29 +968,57 @@ class TestBox:
         self.add_image_slice(question_num, group_num, box)
         self.unsure.append(question_num)
 
-    def get_bubble_intensity(self, bubble, box):
+    def get_bubble_roi(self, bubble, box):
         """
-        Calculates the percentage of darkened pixels in the bubble contour.
+        Rasterizes a (shrunken) bubble ellipse inside its bounding rectangle instead of the whole box.
 
         Args:
-            bubble (numpy.ndarray): An ndarray representing the bubble.
+            bubble (tuple): The ellipse ((x, y), (width, height), angle) of the bubble.
             box (numpy.ndarray): An ndarray representing the test box image.
 
         Returns:
-            float: The percentage of darkened pixels in the bubble contour.
-
-        """
-        # Sum up all of the pixel values (0 to 255) inside a bubble 
-        
-        zero_box = np.zeros_like(box)
-        cv.ellipse(zero_box, bubble, 255, -1)
+            roi (numpy.ndarray): The part of the box around the bubble or None if the bubble is outside the box.
+            mask (numpy.ndarray): 255 where the bubble is in roi.
+
+        """
+        (x, y), (width, height), angle = bubble
+        # A little padding makes sure the rectangle fits everything cv.ellipse draws.
+        radius = math.ceil(max(width, height)/2) + 2
+        box_height, box_width = box.shape[:2]
+        x_min = max(math.floor(x) - radius, 0)
+        y_min = max(math.floor(y) - radius, 0)
+        x_max = min(math.ceil(x) + radius + 1, box_width)
+        y_max = min(math.ceil(y) + radius + 1, box_height)
+        if x_min >= x_max or y_min >= y_max:
+            return None, None
+        # Shifting the ellipse by whole pixels rasterizes it exactly like it would be in the full box.
+        mask = np.zeros((y_max - y_min, x_max - x_min), dtype=np.uint8)
+        cv.ellipse(mask, ((x - x_min, y - y_min), (width, height), angle), 255, -1)
         #Could be useful to visualize this function|
         #                                          V
                                                 #if self.debug_mode:
-                                                    #cv.imshow('', zero_box)
+                                                    #cv.imshow('', mask)
                                                     #cv.waitKey()
-        pts = np.where(zero_box == 255)
-        return box[pts[0], pts[1]]
+        return box[y_min:y_max, x_min:x_max], mask
+
+    def get_bubble_intensities(self, bubbles, box):
+        """
+        Sums up the pixel values (0 to 255) inside each bubble.
+
+        Args:
+            bubbles (list): A list of (shrunken) bubble ellipses.
+            box (numpy.ndarray): An ndarray representing the test box image.
+
+        Returns:
+            numpy.ndarray: The sum of the pixel values inside each bubble.
+
+        """
+        intensities = np.zeros(len(bubbles), dtype=np.int64)
+        for i, bubble in enumerate(bubbles):
+            roi, mask = self.get_bubble_roi(bubble, box)
+            if roi is not None:
+                intensities[i] = np.sum(roi, where=mask == 255, dtype=np.int64)
+        return intensities
 
     def format_answer(self, bubbled, question_num):
         """
@@ -1021,10 +1133,7 @@ class TestBox:
             unsure = True
             self.handle_unsure_question(question_num, group_num, box)
 
-        bubble_vals=[]
-        for bubble in question:
-            bubble_intensity = sum(self.get_bubble_intensity(bubble, box))
-            bubble_vals.append(bubble_intensity)
+        bubble_vals = list(self.get_bubble_intensities(question, box))
 
         # Add image slice if program running in verbose mode and image slice not
         # already added.
@@ -1100,6 +1209,7 @@ class TestBox:
         return shrunken_bubbles
 
 
+    @instrumentation.stage('get_bubble_vals')
     def get_bubble_vals(self, bubbles, nonbubbles, box, graybox):
         """
         Populates a dict with the pixel intensities of each bubble
@@ -1168,6 +1278,7 @@ class TestBox:
         med = np.median(question_vals)
         return np.average([(v-med)**2 for v in question_vals])     
 
+    @instrumentation.stage('grade_bubbles')
     def grade_bubbles(self, bubble_vals, bubbled):
         # Goes through all bubbles and decides whether they're closer to the 
         # median filled or the median unfilled and updates bubbled accordingly
@@ -1226,6 +1337,52 @@ class TestBox:
 
         return answer
 
+    @instrumentation.stage('search_threshold_constants')
+    def search_threshold_constants(self, gradable_box, gradable_im, expected_bubble_num):
+        """
+        Searches the box threshold constants for one where we find the expected number of bubbles.
+        Bubble count is close to unimodal in the constant, so we bracket it with a few coarse
+        probes and refine from there instead of trying all of them.
+
+        Args:
+            gradable_box (numpy.ndarray): The thresholded box we use for constant 0.
+            gradable_im (numpy.ndarray): The inverted grayscale box we threshold for the other constants.
+            expected_bubble_num (int): How many bubbles the box should have.
+
+        Returns:
+            constant (float): The first constant (in search order) we found the expected number
+                of bubbles with, or the one that got closest. This can be a larger constant than
+                the smallest one that works, see utils.coarse_to_fine_search.
+            num_bubbles (int): How many bubbles we found with that constant.
+            (bubbles, nonbubbles, gradable_box): What get_bubbles found with that constant and the 
+                thresholded box it looked at.
+
+        """
+        # Only the constant changes between probes, so the filtering and local mean for the box
+        # are computed once (the first time we need them) and every probe thresholds into the same buffer.
+        thresholds = None
+        threshold_buffer = np.empty_like(gradable_im)
+
+        def get_box_threshold(constant, out=None):
+            nonlocal thresholds
+            if constant == 0:
+                return gradable_box
+            if thresholds is None:
+                thresholds = utils.ThresholdFamily(cv.bitwise_not(gradable_im))
+            return thresholds.threshold(constant, out)
+
+        def count_bubbles(constant):
+            instrumentation.count('box_threshold_probes')
+            bubbles, nonbubbles = self.get_bubbles(get_box_threshold(constant, threshold_buffer))
+            num_bubbles = sum([len(g) for g in bubbles])
+            print(f"Found {num_bubbles} with threshold constant {constant}")
+            return num_bubbles, (bubbles, nonbubbles)
+
+        constant, num_bubbles, (bubbles, nonbubbles) = utils.coarse_to_fine_search(
+            np.linspace(0, 30, 75), count_bubbles, expected_bubble_num, max_probes=self.max_threshold_probes)
+        # The buffer holds whichever constant we probed last, so the chosen one gets its own copy.
+        return constant, num_bubbles, (bubbles, nonbubbles, get_box_threshold(constant))
+
     def grade(self, page_number, box_num):
         """
         Finds and grades a test box within a test image.
@@ -1252,20 +1409,12 @@ class TestBox:
             if treatment == 'erase_lines':
                 gradable_box = self.erase_lines(gradable_box)
 
-            for constant in np.linspace(0, 30, 75):
-                if constant > 0:
-                    gradable_box = utils.get_threshold(cv.bitwise_not(gradable_im), constant)
-                
-                bubbles, nonbubbles = self.get_bubbles(gradable_box)
-                
-                expected_bubble_num = self.bubbles_per_q*self.num_questions
-                num_bubbles = sum([len(g) for g in bubbles])
-                print(f"Found {num_bubbles} with threshold constant {constant}")
-                if num_bubbles == expected_bubble_num:
-                    break
+            expected_bubble_num = self.bubbles_per_q*self.num_questions
+            constant, num_bubbles, (bubbles, nonbubbles, gradable_box) = \
+                self.search_threshold_constants(gradable_box, gradable_im, expected_bubble_num)
             try:
                 if num_bubbles != expected_bubble_num:
-                    raise Exception(f"Found {num_bubbles}/{expected_bubble_num} after trying all thresholds")
+                    raise Exception(f"Found {num_bubbles}/{expected_bubble_num} after searching the thresholds (closest with threshold constant {constant})")
                 bubble_vals = self.get_bubble_vals(bubbles, nonbubbles, gradable_box, gradable_im)
             except Exception as err:
                 print(err)
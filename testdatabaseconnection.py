@@ -7,5 +7,5 @@ examinfo = {
     'Test ID': 'Practice Test #1'
     }
 
-page_answers = [{1: 'A', 2: 'B', 3: 12.4}]
+page_answers = {'1': {1: 'A', 2: 'B', 3: 12.4}}
 upload_to_database(examinfo, page_answers)
\ No newline at end of file
@@ -1,4 +1,5 @@
 import base64
+import io
 import math
 
 import cv2 as cv
@@ -18,6 +19,17 @@ def get_threshold(im, constant):
         threshold (numpy.ndarray): An ndarray representing the blurred and
             thresholded image.
 
+    """
+    neighborhood = get_threshold_neighborhood(im)
+    blurred = cv.GaussianBlur(im, (1, 1), 0)
+    blurred = cv.bilateralFilter(blurred,5,50,50)
+    threshold = cv.adaptiveThreshold(blurred,255,cv.ADAPTIVE_THRESH_GAUSSIAN_C,\
+            cv.THRESH_BINARY_INV, neighborhood, constant)
+    return threshold
+
+def get_threshold_neighborhood(im):
+    """
+    Returns the (odd) block size get_threshold uses for the adaptive threshold of an image.
     """
     w, h = im.shape
     neighborhood = int(w*h/15000)
@@ -25,11 +37,100 @@ def get_threshold(im, constant):
         neighborhood = neighborhood + 1
     if neighborhood <= 1:
         neighborhood = 3
-    blurred = cv.GaussianBlur(im, (1, 1), 0)
-    blurred = cv.bilateralFilter(blurred,5,50,50)
-    threshold = cv.adaptiveThreshold(blurred,255,cv.ADAPTIVE_THRESH_GAUSSIAN_C,\
-            cv.THRESH_BINARY_INV, neighborhood, constant)
-    return threshold
+    return neighborhood
+
+class ThresholdFamily:
+    """
+    Does all the work of get_threshold that doesn't depend on the threshold constant once,
+    so that thresholding the same image with many constants only costs one comparison each.
+    The thresholds are identical to what get_threshold returns for the same image and constant.
+    """
+    def __init__(self, im):
+        """
+        Args:
+            im (numpy.ndarray): An ndarray representing a grayscale image.
+        """
+        neighborhood = get_threshold_neighborhood(im)
+        blurred = cv.GaussianBlur(im, (1, 1), 0)
+        self.filtered = cv.bilateralFilter(blurred,5,50,50)
+        # This is the local mean adaptiveThreshold computes for ADAPTIVE_THRESH_GAUSSIAN_C, 
+        # including the rounding back to uint8.
+        local_mean = cv.GaussianBlur(self.filtered.astype(np.float32), (neighborhood, neighborhood), 0,
+                                     borderType=cv.BORDER_REPLICATE | cv.BORDER_ISOLATED)
+        local_mean = np.clip(np.rint(local_mean), 0, 255).astype(np.uint8)
+        self.difference = cv.subtract(self.filtered, local_mean, dtype=cv.CV_16S)
+
+    def threshold(self, constant, out=None):
+        """
+        Thresholds the image with the given constant.
+
+        Args:
+            constant (float): The constant subtracted from the local mean.
+            out (numpy.ndarray): Optional uint8 ndarray to write the threshold into.
+
+        Returns:
+            threshold (numpy.ndarray): An ndarray representing the blurred and
+                thresholded image.
+
+        """
+        # THRESH_BINARY_INV keeps a pixel when (pixel - local mean) <= -floor(constant)
+        return cv.compare(self.difference, -math.floor(constant), cv.CMP_LE, dst=out)
+
+def coarse_to_fine_search(candidates, evaluate, target, num_coarse=8, max_probes=16):
+    """
+    Looks for a candidate where evaluate gives exactly target without evaluating every candidate.
+    It assumes the distance from target is roughly unimodal over the candidates: it probes
+    num_coarse evenly spaced candidates (always including the first and the last), then
+    narrows in around the closest probe, halving the step each time.
+
+    When there are no more than num_coarse candidates, every one of them is probed in order,
+    so this is the same as a linear scan. Otherwise it returns the first hit in probe order,
+    which is not always the smallest candidate that hits target: a linear scan would stop at
+    a hit that sits between two coarse probes before it reaches a later probed one.
+    candidates[0] is always probed first, so a hit there is found either way.
+
+    Args:
+        candidates (list): The values to search, in order of preference.
+        evaluate (function): Takes a candidate and returns (count, result).
+        target (int): The count we are looking for.
+        num_coarse (int): How many candidates to probe before refining.
+        max_probes (int): The most candidates we will ever evaluate.
+
+    Returns:
+        candidate: The first candidate (in probe order) that hit target, or the closest one
+            we probed, preferring the earliest candidate on ties.
+        count (int): The count for that candidate.
+        result: The result evaluate returned for that candidate.
+
+    """
+    probes = {}
+
+    def probe(index):
+        if index not in probes:
+            probes[index] = evaluate(candidates[index])
+        return probes[index][0] == target
+
+    def closest_index():
+        return min(probes, key=lambda i: (abs(probes[i][0] - target), i))
+
+    step = max(math.ceil((len(candidates) - 1) / (num_coarse - 1)), 1)
+    coarse_indices = list(range(0, len(candidates), step))
+    if coarse_indices[-1] != len(candidates) - 1:
+        coarse_indices.append(len(candidates) - 1)
+    for index in coarse_indices[:max_probes]:
+        if probe(index):
+            return candidates[index], probes[index][0], probes[index][1]
+
+    step //= 2
+    while step > 0 and len(probes) < max_probes:
+        best = closest_index()
+        for index in (best - step, best + step):
+            if 0 <= index < len(candidates) and len(probes) < max_probes and probe(index):
+                return candidates[index], probes[index][0], probes[index][1]
+        if closest_index() == best:
+            step //= 2
+    best = closest_index()
+    return candidates[best], probes[best][0], probes[best][1]
 
 def get_euclidian_distance(point1, point2):
     x_dif = point1[0] - point2[0]
@@ -141,3 +242,128 @@ def encode_image(image):
         _, binary = cv.imencode('.png', image)
         encoded = base64.b64encode(binary)
         return encoded.decode('utf-8')
+
+
+def iter_jpeg_segments(f):
+    """
+    Walks the markers of a JPEG file until its image data starts.
+
+    Args:
+        f (file): The JPEG, opened in binary mode and positioned just after the start of image marker.
+
+    Yields:
+        (marker, length): The marker of each segment and the length of its data. f is positioned 
+            at the start of the data, and the walk continues from wherever f is left.
+
+    """
+    while True:
+        byte = f.read(1)
+        if not byte:
+            return
+        if byte != b'\xff':
+            continue
+        marker = f.read(1)
+        while marker == b'\xff':
+            marker = f.read(1)
+        if not marker:
+            return
+        marker = marker[0]
+        # Markers without a length.
+        if marker == 0x01 or 0xd0 <= marker <= 0xd9:
+            continue
+        length = int.from_bytes(f.read(2), 'big') - 2
+        if length < 0:
+            return
+        start = f.tell()
+        yield marker, length
+        # Start of scan, the image data follows.
+        if marker == 0xda:
+            return
+        f.seek(start + length)
+
+def get_image_size(image):
+    """
+    Reads the width and height of a PNG or JPEG image from its header, without decoding it.
+    This is the size as stored, before any EXIF orientation is applied.
+
+    Args:
+        image (str or bytes): Filepath to the image, or the contents of the image file.
+
+    Returns:
+        tuple: (width, height) of the image, or None if it isn't a PNG or JPEG or the header can't be read.
+
+    """
+    try:
+        with (open(image, 'rb') if isinstance(image, str) else io.BytesIO(image)) as f:
+            header = f.read(24)
+            if header[:8] == b'\x89PNG\r\n\x1a\n' and header[12:16] == b'IHDR':
+                return int.from_bytes(header[16:20], 'big'), int.from_bytes(header[20:24], 'big')
+            if header[:2] != b'\xff\xd8':
+                return None
+            f.seek(2)
+            for marker, _ in iter_jpeg_segments(f):
+                # Start of frame markers (0xc4, 0xc8 and 0xcc are other things).
+                if 0xc0 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc):
+                    frame = f.read(5)
+                    if len(frame) < 5:
+                        return None
+                    return int.from_bytes(frame[3:5], 'big'), int.from_bytes(frame[1:3], 'big')
+            return None
+    except OSError:
+        return None
+
+def get_exif_orientation(image):
+    """
+    Reads the EXIF orientation tag of a JPEG image, without decoding it.
+
+    Args:
+        image (str or bytes): Filepath to the image, or the contents of the image file.
+
+    Returns:
+        int: The orientation (1 to 8), or 1 if the image isn't a JPEG or has no orientation tag.
+
+    """
+    try:
+        with (open(image, 'rb') if isinstance(image, str) else io.BytesIO(image)) as f:
+            if f.read(2) != b'\xff\xd8':
+                return 1
+            for marker, length in iter_jpeg_segments(f):
+                if marker != 0xe1 or length < 14:
+                    continue
+                app1 = f.read(length)
+                if app1[:6] != b'Exif\x00\x00':
+                    continue
+                tiff = app1[6:]
+                byteorder = {b'II': 'little', b'MM': 'big'}.get(tiff[:2])
+                if byteorder is None:
+                    return 1
+                ifd = int.from_bytes(tiff[4:8], byteorder)
+                num_entries = int.from_bytes(tiff[ifd:ifd+2], byteorder)
+                for entry in range(ifd + 2, ifd + 2 + 12*num_entries, 12):
+                    if int.from_bytes(tiff[entry:entry+2], byteorder) == 0x0112:
+                        orientation = int.from_bytes(tiff[entry+8:entry+10], byteorder)
+                        return orientation if 1 <= orientation <= 8 else 1
+                return 1
+            return 1
+    except OSError:
+        return 1
+
+def apply_exif_orientation(im, orientation):
+    """
+    Turns a decoded image upright the way cv.imread does for the given EXIF orientation.
+
+    Args:
+        im (numpy.ndarray): An ndarray representing the image as stored.
+        orientation (int): The EXIF orientation of the image (1 to 8).
+
+    Returns:
+        numpy.ndarray: The upright image.
+
+    """
+    if orientation >= 5:
+        im = cv.transpose(im)
+    # How cv.imread flips for each orientation (after transposing 5 to 8).
+    flip = {2: 1, 3: -1, 4: 0, 6: 1, 7: -1, 8: 0}.get(orientation)
+    if flip is not None:
+        im = cv.flip(im, flip)
+    return im
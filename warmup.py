@@ -0,0 +1,59 @@
+import contextlib
+import os
+import time
+
+import cv2 as cv
+import numpy as np
+
+import config_registry
+import grader as g
+import telemetry
+from email_templates import email_templates
+
+
+def get_synthetic_page():
+    """
+    Returns:
+        im (numpy.ndarray): A blank page with an outline and one empty box, big enough to get past the
+            resolution check, so grading it runs the page and box finding code.
+    """
+    im = np.full((1300, 1000, 3), 255, np.uint8)
+    cv.rectangle(im, (50, 50), (950, 1250), (0, 0, 0), 8)
+    cv.rectangle(im, (150, 300), (850, 700), (0, 0, 0), 4)
+    return im
+
+
+def warm_up():
+    """
+    Pays the cold start costs of a worker up front: validates every config, compiles the email
+    templates, builds the telemetry sink and grades a synthetic page (which loads OpenCV's lazily
+    initialized code). Run in the celery parent before it forks, the pool's children start hot.
+
+    Returns:
+        timings (dict): How long each step took, in seconds, and the total.
+    """
+    timings = {}
+
+    @contextlib.contextmanager
+    def step(name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            timings[name] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with step('configs'):
+        config_errors = config_registry.registry.preload()
+    for config_fname, error in config_errors.items():
+        print(f'Invalid config {config_fname}: {error}')
+    with step('email_templates'):
+        email_templates.get_templates()
+    with step('telemetry'):
+        telemetry.get_csv_logger()
+    with step('synthetic_page'):
+        g.Grader().grade_page(get_synthetic_page(), False, False, 1.0, 'sat', 1, 'warmup')
+    timings['total'] = time.perf_counter() - start
+    steps = ', '.join(f'{name} {elapsed:.2f}s' for name, elapsed in timings.items() if name != 'total')
+    print(f'Worker {os.getpid()} warmed up in {timings["total"]:.2f}s ({steps})')
+    return timings
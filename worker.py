@@ -3,6 +3,11 @@ from celery import Celery
 
 
 broker_url = os.getenv('CELERY_BROKER_URL')
+# Optional. With a result backend (that supports chords), grade_test grades the pages of a submission in parallel.
+result_backend = os.getenv('CELERY_RESULT_BACKEND')
+# Optional. Emails go to this queue, served by its own I/O worker, so slow SMTP never holds up a grading
+# worker. Without it they go to the default queue like every other task.
+email_queue = os.getenv('CELERY_EMAIL_QUEUE')
 
 if broker_url == 'filesystem://':
     #local computer
@@ -27,3 +32,9 @@ if broker_url == 'filesystem://':
 else:
     #server
     celeryapp = Celery('tasks', broker='pyamqp://guest@localhost//')
+
+if result_backend:
+    celeryapp.conf.update({'result_backend': result_backend})
+
+if email_queue:
+    celeryapp.conf.update({'task_routes': {'graderapi.send_email_task': {'queue': email_queue}}})